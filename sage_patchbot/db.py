@@ -1,22 +1,114 @@
 # to launch a mongo console:
 # mongod --port=21002
+#
+# maintenance commands:
+# python -m sage_patchbot.db migrate_reports
+# python -m sage_patchbot.db rebuild_summaries
+# python -m sage_patchbot.db rebuild_trusted_authors
+# python -m sage_patchbot.db rebuild_machines
+# python -m sage_patchbot.db rebuild_bases
+# python -m sage_patchbot.db sweep_pending
+
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
 
 import gridfs
+from pymongo import ReturnDocument, monitoring
 from pymongo.mongo_client import MongoClient
 
-mongodb = MongoClient().buildbot
+from . import metrics
+from .util import (get_ticket_status, comparable_version, now_str,
+                   DATE_FORMAT)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Record the time of the commands sent to mongodb, see ``metrics``.
+    """
+    def __init__(self):
+        # request id -> collection of the command
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, (str, type(u''))):
+            collection = ''
+        self.collections[event.request_id] = collection
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        collection = self.collections.pop(event.request_id, '')
+        metrics.MONGO_SECONDS.observe(event.duration_micros / 1e6,
+                                      event.command_name, collection)
+
+
+mongodb = MongoClient(event_listeners=[CommandTimer()]).buildbot
 tickets = mongodb.tickets
 tickets.ensure_index('id', unique=True)
 tickets.ensure_index('status')
 tickets.ensure_index('authors')
 tickets.ensure_index('participants')
 tickets.ensure_index('last_activity')
-tickets.ensure_index('reports.base')
-tickets.ensure_index('reports.machine')
-tickets.ensure_index('reports.time')
+tickets.ensure_index([('last_trac_activity', -1), ('id', -1)])
+
+# one document per report, with the id of its ticket in ``ticket_id``
+reports = mongodb.reports
+reports.ensure_index([('ticket_id', 1), ('base', 1),
+                      ('machine', 1), ('time', 1)])
+reports.ensure_index([('ticket_id', 1), ('time', -1)])
+reports.ensure_index('machine')
+reports.ensure_index('time')
+# pending reports by age, see ``sweep_pending``
+reports.ensure_index([('status', 1), ('time', 1)])
+
+# one document per (ticket, base) with the status of the ticket,
+# see ``save_summary``
+summaries = mongodb.summaries
+summaries.ensure_index([('ticket_id', 1), ('base', 1)], unique=True)
+
+# author full name -> number of fixed tickets, see ``save_trusted_authors``
+trusted_authors = mongodb.trusted_authors
+trusted_authors.ensure_index('author', unique=True)
+
+# one document per machine with statistics on its reports,
+# see ``save_machine_report``
+machines = mongodb.machines
+machines.ensure_index('machine', unique=True)
+machines.ensure_index('last_report')
+
+# the bases of the reports on the pseudo-ticket 0, with their position
+# in ``rank`` when sorted by ``comparable_version``, see ``save_base``
+bases = mongodb.bases
+bases.ensure_index('base', unique=True)
+bases.ensure_index('rank')
+
+# small values kept by the server processes, see ``save_state``
+state = mongodb.state
 
 logs = gridfs.GridFS(mongodb, 'logs')
 
+# diffs of plugin logs against the base, see ``save_plugin_diff``
+plugin_diffs = mongodb.plugin_diffs
+plugin_diffs.ensure_index([('log', 1), ('base_log', 1), ('plugin', 1)],
+                          unique=True)
+plugin_diffs.ensure_index('base_log')
+
+# larger diffs are not kept
+MAX_PLUGIN_DIFF_SIZE = 2 ** 20
+
+# seconds after which a pending report is removed
+PENDING_TIMEOUT = 6 * 60 * 60
+
+# fields of a ticket on which its status depends, see
+# ``util.get_ticket_status``
+STATUS_FIELDS = ('git_commit', 'spkgs', 'depends_on')
+
 
 def lookup_ticket(ticket_id):
     """
@@ -28,17 +120,560 @@ def lookup_ticket(ticket_id):
 def save_ticket(ticket_data):
     """
     Save ticket data in the database
+
+    Only the given fields are set, with a single atomic update, so that
+    concurrent writers of other fields are not overwritten. The reports
+    are not part of the ticket document, see ``save_report``.
+
+    This also refreshes the counts of trusted authors, and the status
+    summaries of the ticket if one of ``STATUS_FIELDS`` changed. The
+    summaries are refreshed for new reports by ``save_summary``.
+    """
+    fields = dict((key, value) for key, value in ticket_data.items()
+                  if key not in ('_id', 'reports'))
+    old = tickets.find_one_and_update({'id': ticket_data['id']},
+                                      {'$set': fields}, upsert=True,
+                                      return_document=ReturnDocument.BEFORE)
+    old_authors = fixed_authors(old) if old else []
+    ticket_data = dict(old or {})
+    ticket_data.update(fields)
+    if old and old.get('git_commit') != ticket_data.get('git_commit'):
+        # the reports made so far are on another commit
+        machines.update_many({'fresh_tickets': ticket_data['id']},
+                             {'$pull': {'fresh_tickets': ticket_data['id']}})
+    if old is None or any(old.get(key) != ticket_data.get(key)
+                          for key in STATUS_FIELDS):
+        save_summary(ticket_data)
+    save_trusted_authors(old_authors, fixed_authors(ticket_data))
+
+
+def feed_version(query):
+    """
+    Return the number of tickets matching ``query`` and their latest
+    ``last_activity``.
+    """
+    pipeline = [{'$match': query},
+                {'$group': {'_id': None,
+                            'count': {'$sum': 1},
+                            'last_activity': {'$max': '$last_activity'}}}]
+    for doc in tickets.aggregate(pipeline):
+        return doc['count'], doc['last_activity']
+    return 0, None
+
+
+def lookup_reports(ticket_id, base=None, skip=0, limit=0):
+    """
+    Return the reports of a ticket, newest first.
+
+    INPUT:
+
+    - ``ticket_id`` -- integer
+
+    - ``base`` -- if given, only return the reports on this base
+
+    - ``skip``, ``limit`` -- to read the reports page by page
+    """
+    query = {'ticket_id': ticket_id}
+    if base is not None:
+        query['base'] = base
+    cursor = reports.find(query, {'_id': False, 'ticket_id': False})
+    return list(cursor.sort('time', -1).skip(skip).limit(limit))
+
+
+def load_reports(ticket):
+    """
+    Set ``ticket['reports']`` to the list of all its reports.
+
+    Return the ticket.
+    """
+    ticket['reports'] = lookup_reports(ticket['id'])
+    return ticket
+
+
+def with_reports(ticket_list, chunk_size=100):
+    """
+    Iterate over the tickets with their reports loaded.
+
+    The reports are read with one query for every ``chunk_size`` tickets.
+    """
+    chunk = []
+    for ticket in ticket_list:
+        chunk.append(ticket)
+        if len(chunk) == chunk_size:
+            for t in _attach_reports(chunk):
+                yield t
+            chunk = []
+    for t in _attach_reports(chunk):
+        yield t
+
+
+def _attach_reports(chunk):
+    by_id = {}
+    for ticket in chunk:
+        ticket['reports'] = []
+        by_id[ticket['id']] = ticket
+    if by_id:
+        query = {'ticket_id': {'$in': list(by_id)}}
+        for report in reports.find(query, {'_id': False}).sort('time', -1):
+            by_id[report.pop('ticket_id')]['reports'].append(report)
+    return chunk
+
+
+def report_bases(ticket_id):
+    """
+    Return the list of bases of the reports of a ticket.
+    """
+    return reports.distinct('base', {'ticket_id': ticket_id})
+
+
+def save_report(ticket_id, report):
+    """
+    Add a report to a ticket.
+    """
+    save_reports([(ticket_id, report)])
+
+
+def save_reports(ticket_reports):
+    """
+    Add reports, given as pairs (ticket id, report), with a single insert.
+
+    A report that is already stored (same ticket, machine, time and
+    status) is replaced, so that saving reports again does no harm.
+
+    Return the list of the pairs (ticket id, report) that were not
+    already stored.
+    """
+    docs = [dict(report, ticket_id=ticket_id)
+            for ticket_id, report in ticket_reports]
+    if not docs:
+        return []
+
+    def key(doc):
+        return (doc['ticket_id'], tuple(doc['machine']), doc['time'],
+                doc['status'])
+    same = {'$or': [{'ticket_id': doc['ticket_id'],
+                     'machine': doc['machine'],
+                     'time': doc['time'],
+                     'status': doc['status']}
+                    for doc in docs]}
+    stored = set(key(doc) for doc in reports.find(same, {'_id': False}))
+    reports.delete_many(same)
+    reports.insert_many(docs)
+    for doc in docs:
+        if doc['ticket_id'] == 0:
+            save_base(doc['base'])
+    return [(ticket_id, report)
+            for (ticket_id, report), doc in zip(ticket_reports, docs)
+            if key(doc) not in stored]
+
+
+def remove_report(ticket_id, report):
+    """
+    Remove a report of a ticket.
+
+    Reports are identified by their machine, time and status.
+    """
+    reports.delete_one({'ticket_id': ticket_id,
+                        'machine': report['machine'],
+                        'time': report['time'],
+                        'status': report['status']})
+
+
+def migrate_reports():
+    """
+    Move the reports stored inside the ticket documents to ``reports``.
+
+    This can be interrupted and run again. Only the copies of the
+    embedded reports are replaced, so that the reports posted to the
+    ``reports`` collection since the upgrade are kept.
+    """
+    for ticket in tickets.find({'reports': {'$exists': True}}):
+        ticket_id = ticket['id']
+        save_reports([(ticket_id, report) for report in ticket['reports']])
+        tickets.update_one({'id': ticket_id}, {'$unset': {'reports': ''}})
+        save_summary(ticket)
+    indexes = tickets.index_information()
+    for name in ('reports.base_1', 'reports.machine_1', 'reports.time_1'):
+        if name in indexes:
+            tickets.drop_index(name)
+
+
+def save_summary(ticket, bases=None):
+    """
+    Store the status of the ticket for every base it has reports on.
+
+    There is one summary document for each base, plus the documents
+    with base ``'all'`` (all reports) and ``'latest'`` (reports on the
+    newest base of the ticket). Each of them contains the triple
+    returned by ``get_ticket_status`` and the number of pending reports.
+
+    This is what the ticket list reads instead of the full reports.
+
+    If ``bases`` is given, only the reports on these bases changed, and
+    only their summaries and those of ``'all'`` and ``'latest'`` are
+    computed again.
+    """
+    ticket_id = ticket['id']
+    ticket = load_reports(dict(ticket))
+    pending = len([r for r in ticket['reports'] if r['status'] == 'Pending'])
+    report_bases = set(report['base'] for report in ticket['reports'])
+    keys = {'all': None, 'latest': 'latest'}
+    for base in report_bases if bases is None else report_bases & set(bases):
+        keys[base] = base
+    if bases is not None:
+        summaries.update_many({'ticket_id': ticket_id},
+                              {'$set': {'pending': pending}})
+    for key, base in keys.items():
+        count, single, composite = get_ticket_status(ticket, base=base)
+        summaries.replace_one({'ticket_id': ticket_id, 'base': key},
+                              {'ticket_id': ticket_id,
+                               'base': key,
+                               'report_count': count,
+                               'report_status': single,
+                               'report_status_composite': composite,
+                               'pending': pending},
+                              upsert=True)
+    summaries.delete_many({'ticket_id': ticket_id,
+                           'base': {'$nin': ['all', 'latest'] +
+                                    list(report_bases)}})
+
+
+def lookup_summaries(ticket_ids, base):
+    """
+    Return a dict ticket id -> summary document for the given base.
+
+    Tickets without summary for this base are missing from the dict.
+    """
+    return {summary['ticket_id']: summary
+            for summary in summaries.find({'ticket_id': {'$in': ticket_ids},
+                                           'base': base})}
+
+
+def rebuild_summaries():
+    """
+    Recompute the status summaries of all tickets.
+    """
+    for ticket in tickets.find():
+        save_summary(ticket)
+
+
+def fixed_authors(ticket):
+    """
+    Return the authors that the ticket makes trusted.
+
+    Somebody is trusted if he/she is the author of a closed patch
+    with 'fixed' status and milestone != sage-duplicate/invalid/wontfix.
+    """
+    if (ticket.get('status') != 'closed' or
+            ticket.get('resolution') != 'fixed' or
+            ticket.get('milestone') == 'sage-duplicate/invalid/wontfix'):
+        return []
+    authors = [author.strip()
+               for author in ticket.get('authors_fullnames', [])]
+    return [a for a in authors if a and a != '<no author>']
+
+
+def save_trusted_authors(old_authors, new_authors):
+    """
+    Update the counts of trusted authors when a ticket changes.
+
+    INPUT:
+
+    - ``old_authors``, ``new_authors`` -- the values of ``fixed_authors``
+      for the ticket before and after the change
+    """
+    delta = Counter(new_authors)
+    delta.subtract(Counter(old_authors))
+    for author, count in delta.items():
+        if count:
+            trusted_authors.update_one({'author': author},
+                                       {'$inc': {'count': count}},
+                                       upsert=True)
+    if any(count < 0 for count in delta.values()):
+        trusted_authors.delete_many({'count': {'$lte': 0}})
+
+
+def lookup_trusted_authors(authors=None):
+    """
+    Return a dict author -> number of fixed tickets.
+
+    If ``authors`` is given, only these authors are looked up.
+    """
+    query = {'count': {'$gt': 0}}
+    if authors is not None:
+        query['author'] = {'$in': list(authors)}
+    return {doc['author']: doc['count']
+            for doc in trusted_authors.find(query)}
+
+
+def rebuild_trusted_authors():
+    """
+    Recompute the counts of trusted authors from all closed tickets.
+    """
+    counts = Counter()
+    for ticket in tickets.find({'status': 'closed', 'resolution': 'fixed'}):
+        counts.update(fixed_authors(ticket))
+    trusted_authors.delete_many({})
+    if counts:
+        trusted_authors.insert_many([{'author': author, 'count': count}
+                                     for author, count in counts.items()])
+
+
+def save_machine_report(ticket, report):
+    """
+    Record a new report in the statistics of the machine that made it.
+
+    Pending reports only update the time of the last report. A ticket
+    stays among the fresh tickets of the machine until its commit
+    changes, see ``save_ticket``.
+    """
+    update = {'$max': {'last_report': report['time']}}
+    if report['status'] != 'Pending':
+        update['$inc'] = {'report_count': 1,
+                          'status_counts.' + report['status']: 1}
+        update['$addToSet'] = {'all_tickets': ticket['id']}
+        if report.get('git_commit') == ticket.get('git_commit'):
+            update['$addToSet']['fresh_tickets'] = ticket['id']
+    machines.update_one({'machine': report['machine']}, update, upsert=True)
+
+
+def aggregate_machines(query, authors=None):
+    """
+    Compute the statistics of machines on the tickets matching ``query``.
+
+    This is done by the database and returns documents of the same shape
+    as the ones in the ``machines`` collection, newest first. As there,
+    pending reports are not counted.
+
+    If ``authors`` is given, only keep tickets with authors among them.
+    """
+    query = dict(query)
+    if authors is not None:
+        query['authors'] = {'$not': {'$elemMatch': {'$nin': list(authors)}}}
+    ticket_ids = tickets.distinct('id', query)
+    fresh = {'$cond': [{'$eq': ['$git_commit', '$ticket.git_commit']},
+                       '$ticket_id', None]}
+    pipeline = [{'$match': {'ticket_id': {'$in': ticket_ids},
+                            'status': {'$ne': 'Pending'}}},
+                {'$lookup': {'from': 'tickets', 'localField': 'ticket_id',
+                             'foreignField': 'id', 'as': 'ticket'}},
+                {'$unwind': '$ticket'},
+                {'$group': {'_id': {'machine': '$machine',
+                                    'status': '$status'},
+                            'last_report': {'$max': '$time'},
+                            'report_count': {'$sum': 1},
+                            'all_tickets': {'$addToSet': '$ticket_id'},
+                            'fresh_tickets': {'$addToSet': fresh}}},
+                {'$group': {'_id': '$_id.machine',
+                            'last_report': {'$max': '$last_report'},
+                            'report_count': {'$sum': '$report_count'},
+                            'all_tickets': {'$push': '$all_tickets'},
+                            'fresh_tickets': {'$push': '$fresh_tickets'},
+                            'status_counts': {'$push': {
+                                'status': '$_id.status',
+                                'count': '$report_count'}}}},
+                {'$sort': {'last_report': -1}}]
+    for doc in reports.aggregate(pipeline):
+        yield {'machine': doc['_id'],
+               'last_report': doc['last_report'],
+               'report_count': doc['report_count'],
+               'all_tickets': set(t for ids in doc['all_tickets']
+                                  for t in ids),
+               'fresh_tickets': set(t for ids in doc['fresh_tickets']
+                                    for t in ids if t is not None),
+               'status_counts': {item['status']: item['count']
+                                 for item in doc['status_counts']}}
+
+
+def rebuild_machines():
+    """
+    Recompute the statistics of machines from all reports.
+    """
+    machines.delete_many({})
+    for ticket in tickets.find():
+        for report in reversed(lookup_reports(ticket['id'])):
+            save_machine_report(ticket, report)
+
+
+def save_base(base):
+    """
+    Register a base of the pseudo-ticket 0.
+
+    When the base is new, the ranks of all the bases are recomputed.
+    """
+    if bases.find_one({'base': base}, {'_id': True}) is not None:
+        return
+    known = [doc['base'] for doc in bases.find({}, {'base': True})]
+    known.append(base)
+    known.sort(key=comparable_version)
+    for rank, version in enumerate(known):
+        bases.update_one({'base': version}, {'$set': {'rank': rank}},
+                         upsert=True)
+
+
+def lookup_bases():
+    """
+    Return the list of the bases of the pseudo-ticket 0, oldest first.
+    """
+    return [doc['base'] for doc in bases.find({}, {'base': True}).sort('rank')]
+
+
+def rebuild_bases():
     """
-    old = tickets.find_one({'id': ticket_data['id']})
-    if old:
-        old.update(ticket_data)
-        ticket_data = old
-    tickets.save(ticket_data)
+    Recompute the bases from the reports on the pseudo-ticket 0.
+    """
+    bases.delete_many({})
+    known = sorted(report_bases(0), key=comparable_version)
+    if known:
+        bases.insert_many([{'base': version, 'rank': rank}
+                           for rank, version in enumerate(known)])
+
+
+def lookup_state(key, default=None):
+    """
+    Return the value stored under ``key`` by ``save_state``.
+    """
+    doc = state.find_one({'_id': key})
+    return default if doc is None else doc['value']
+
+
+def save_state(key, value):
+    """
+    Store a value under ``key``.
+    """
+    state.replace_one({'_id': key}, {'_id': key, 'value': value},
+                      upsert=True)
+
+
+def lookup_plugin_diff(logname, base_logname, plugin):
+    """
+    Return the stored diff of a plugin log against the base, or ``None``.
+
+    The result is a document with keys ``header`` and ``diff``.
+    """
+    return plugin_diffs.find_one({'log': logname, 'base_log': base_logname,
+                                  'plugin': plugin})
+
+
+def save_plugin_diff(logname, base_logname, plugin, header, diff):
+    """
+    Store the diff of a plugin log against the base.
+
+    Logs never change once posted, so the diff is computed only once.
+    """
+    if len(diff) > MAX_PLUGIN_DIFF_SIZE:
+        return
+    plugin_diffs.replace_one({'log': logname, 'base_log': base_logname,
+                              'plugin': plugin},
+                             {'log': logname, 'base_log': base_logname,
+                              'plugin': plugin, 'header': header,
+                              'diff': diff},
+                             upsert=True)
+
+
+def log_name(ticket_id, report):
+    return "/log%s/%s/%s/%s" % (
+        '/Pending' if report['status'] == 'Pending' else '',
+        ticket_id,
+        '/'.join(report['machine']),
+        report['time'])
+
+
+def save_log(logname, data, **fields):
+    """
+    Store a log, replacing the log with the same name if any.
+
+    The ``fields`` are stored with the log, see ``serve.post_report``.
+    """
+    if logs.exists(logname):
+        logs.delete(logname)
+    logs.put(data, _id=logname, **fields)
+
+
+def prune_pending(ticket, machine=None, timeout=None):
+    """
+    Remove pending reports of the ticket from the database,
+    as well as the corresponding log.
+
+    A pending report is removed if ``machine`` is matched
+    or ``report.time`` is longer than ``timeout`` old.
+
+    The ``timeout`` is ``PENDING_TIMEOUT`` by default
+
+    Return the list of removed reports.
+    """
+    if timeout is None:
+        timeout = PENDING_TIMEOUT
+    # times are strings in the utc timezone, that compare as the dates
+    oldest = datetime.utcnow() - timedelta(seconds=timeout)
+    query = {'ticket_id': ticket['id'],
+             'status': 'Pending',
+             '$or': [{'machine': machine},
+                     {'time': {'$lt': oldest.strftime(DATE_FORMAT)}}]}
+    removed = list(reports.find(query))
+    if removed:
+        reports.delete_many({'_id': {'$in': [r['_id'] for r in removed]}})
+        for report in removed:
+            remove_log(log_name(ticket['id'], report))
+        # the reports of the ticket changed
+        ticket['last_activity'] = now_str()
+        tickets.update_one({'id': ticket['id']},
+                           {'$set': {'last_activity': ticket['last_activity']}})
+    return removed
+
+
+def sweep_pending(timeout=None):
+    """
+    Remove the pending reports of all tickets that are older than
+    ``timeout`` seconds (``PENDING_TIMEOUT`` by default), with their logs.
+
+    The summaries of the tickets concerned are refreshed.
+
+    Return the number of removed reports.
+    """
+    if timeout is None:
+        timeout = PENDING_TIMEOUT
+    oldest = datetime.utcnow() - timedelta(seconds=timeout)
+    removed = list(reports.find({'status': 'Pending',
+                                 'time': {'$lt': oldest.strftime(DATE_FORMAT)}},
+                                {'ticket_id': True, 'machine': True,
+                                 'time': True, 'status': True,
+                                 'base': True}))
+    if not removed:
+        return 0
+    reports.delete_many({'_id': {'$in': [r['_id'] for r in removed]}})
+    for report in removed:
+        remove_log(log_name(report['ticket_id'], report))
+    bases = {}
+    for report in removed:
+        bases.setdefault(report['ticket_id'], set()).add(report['base'])
+    tickets.update_many({'id': {'$in': list(bases)}},
+                        {'$set': {'last_activity': now_str()}})
+    for ticket in tickets.find({'id': {'$in': list(bases)}}):
+        save_summary(ticket, bases[ticket['id']])
+    return len(removed)
 
 
 def remove_log(logname):
     """
     Remove the log with corresponding logname.
+
+    This also removes the stored plugin diffs involving this log.
     """
     if logs.exists(logname):
         logs.delete(logname)
+    plugin_diffs.delete_many({'$or': [{'log': logname},
+                                      {'base_log': logname}]})
+
+
+commands = {'migrate_reports': migrate_reports,
+            'rebuild_summaries': rebuild_summaries,
+            'rebuild_trusted_authors': rebuild_trusted_authors,
+            'rebuild_machines': rebuild_machines,
+            'rebuild_bases': rebuild_bases,
+            'sweep_pending': sweep_pending}
+
+if __name__ == '__main__':
+    for command in sys.argv[1:]:
+        print(command)
+        commands[command]()
@@ -0,0 +1,399 @@
+"""
+Asynchronous ingestion of the reports posted to the patchbot server.
+
+A posted report is checked and written with its log to a spool
+directory (see ``spool_report``), after which the server answers at
+once. A background thread stores the spooled reports in the database
+by batches (see ``write_batch``).
+
+Every entry of the spool is a json file with the report, next to a
+file with the compressed log. The json file is written last, under a
+temporary name, so that only complete entries are seen. An entry is
+claimed by renaming it, which lets several server processes share the
+same spool.
+"""
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+try:
+    from xmlrpc.client import ProtocolError  # python3
+except ImportError:
+    from xmlrpclib import ProtocolError  # python2
+
+from pymongo.errors import ConnectionFailure
+
+from . import db
+from .trac import scrape
+from .util import (now_str, compress_log_blocks, decompress_log,
+                   plugin_offsets)
+
+SPOOL_DIR = os.environ.get('PATCHBOT_SPOOL_DIR', '/home/patchbot/spool')
+
+# maximal number of reports stored together
+BATCH_SIZE = 50
+
+# seconds between two looks at the spool when no report arrives
+POLL_INTERVAL = 5
+
+# seconds between two removals of the expired pending reports
+SWEEP_INTERVAL = 10 * 60
+
+# failures to reach trac, after which a report is tried again later
+try:
+    TRAC_ERRORS = (ProtocolError, socket.timeout, socket.gaierror,
+                   ConnectionError)
+except NameError:
+    # python2, where the other errors of the files are not socket errors
+    TRAC_ERRORS = (ProtocolError, socket.error)
+
+# seconds before a report is tried again after a failure to reach trac
+RETRY_DELAY = 5 * 60
+
+# failures to reach trac after which a report is set aside
+MAX_ATTEMPTS = 10
+
+# seconds after which a claimed entry is considered abandoned by a
+# process that died, and is put back in the spool
+CLAIM_TIMEOUT = 10 * 60
+
+_writer = {'thread': None, 'last_sweep': 0}
+_writer_lock = threading.Lock()
+_wakeup = threading.Event()
+
+# path of an entry -> time before which it is not tried again
+_retry_after = {}
+
+
+def spool_report(ticket_id, report, log=None, compression='bz2',
+                 log_index=None):
+    """
+    Put a report and its compressed log in the spool.
+
+    INPUT:
+
+    - ``ticket_id`` -- integer
+
+    - ``report`` -- dictionary, already checked
+
+    - ``log`` -- a file-like object with the compressed log, or ``None``
+
+    - ``compression`` -- format of the log, see ``util.LOG_COMPRESSIONS``
+
+    - ``log_index`` -- dictionary of fields stored with the log
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        try:
+            os.makedirs(SPOOL_DIR)
+        except OSError:
+            # created by another thread in the meantime
+            pass
+    name = '{:017d}-{}'.format(int(time.time() * 1e6), uuid.uuid4().hex)
+    path = os.path.join(SPOOL_DIR, name)
+    if log is not None:
+        with open(path + '.log', 'wb') as f:
+            shutil.copyfileobj(log, f)
+            f.flush()
+            os.fsync(f.fileno())
+    entry = {'ticket_id': ticket_id,
+             'report': report,
+             'compression': compression,
+             'log_index': log_index or {},
+             'log': log is not None}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path + '.json')
+    start_writer()
+    _wakeup.set()
+
+
+def start_writer():
+    """
+    Start the thread storing the spooled reports, if not running yet.
+
+    This thread also removes the expired pending reports every
+    ``SWEEP_INTERVAL`` seconds, see ``db.sweep_pending``.
+    """
+    with _writer_lock:
+        if _writer['thread'] is not None:
+            return
+        thread = threading.Thread(target=_writer_loop)
+        thread.daemon = True
+        thread.start()
+        _writer['thread'] = thread
+
+
+def _writer_loop():
+    while True:
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+        try:
+            release_abandoned()
+            while write_batch():
+                pass
+            if time.time() - _writer['last_sweep'] > SWEEP_INTERVAL:
+                _writer['last_sweep'] = time.time()
+                db.sweep_pending()
+        except Exception:
+            traceback.print_exc()
+
+
+def release_abandoned():
+    """
+    Put back in the spool the entries claimed a long time ago.
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    now = time.time()
+    for filename in os.listdir(SPOOL_DIR):
+        if filename.endswith('.claimed'):
+            path = os.path.join(SPOOL_DIR, filename)
+            try:
+                if now - os.path.getmtime(path) > CLAIM_TIMEOUT:
+                    os.rename(path, path[:-len('.claimed')] + '.json')
+            except OSError:
+                pass
+
+
+def claim_batch(size=BATCH_SIZE):
+    """
+    Claim at most ``size`` entries of the spool, oldest first.
+
+    Return the list of their paths, without extension.
+    """
+    if not os.path.isdir(SPOOL_DIR):
+        return []
+    names = sorted(filename[:-len('.json')]
+                   for filename in os.listdir(SPOOL_DIR)
+                   if filename.endswith('.json'))
+    claimed = []
+    now = time.time()
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        if _retry_after.get(path, 0) > now:
+            continue
+        try:
+            os.rename(path + '.json', path + '.claimed')
+        except OSError:
+            # claimed by another process
+            continue
+        _retry_after.pop(path, None)
+        # the time of the claim, see ``release_abandoned``
+        os.utime(path + '.claimed', None)
+        claimed.append(path)
+        if len(claimed) == size:
+            break
+    return claimed
+
+
+def write_batch(size=BATCH_SIZE):
+    """
+    Store at most ``size`` spooled reports in the database.
+
+    If the batch cannot be stored, its reports are stored one by one.
+    A report that fails because trac cannot be reached is tried again
+    later, see ``retry_later``, and the reports that fail for another
+    reason are moved to the ``failed`` subdirectory of the spool. When
+    mongodb cannot be reached, no report can be stored: the reports not
+    stored yet are put back in the spool, and ``0`` is returned so that
+    they are tried again at the next round.
+
+    Return the number of reports taken from the spool.
+    """
+    paths = claim_batch(size)
+    entries = []
+    for path in paths:
+        with open(path + '.claimed') as f:
+            entry = json.load(f)
+        entry['path'] = path
+        entries.append(entry)
+    if not entries:
+        return 0
+    try:
+        store_reports(entries)
+    except ConnectionFailure:
+        traceback.print_exc()
+        for entry in entries:
+            release_entry(entry)
+        return 0
+    except Exception:
+        traceback.print_exc()
+        for i, entry in enumerate(entries):
+            try:
+                store_reports([entry])
+            except ConnectionFailure:
+                traceback.print_exc()
+                for other in entries[i:]:
+                    release_entry(other)
+                return 0
+            except TRAC_ERRORS:
+                traceback.print_exc()
+                retry_later(entry)
+            except Exception:
+                traceback.print_exc()
+                set_aside(entry)
+            else:
+                remove_entry(entry)
+    else:
+        for entry in entries:
+            remove_entry(entry)
+    return len(entries)
+
+
+def store_reports(entries):
+    """
+    Store spooled reports in the database.
+
+    The reports are inserted together, followed by their logs. A
+    pending report that is followed in the same batch by another report
+    of the same machine on the same ticket is dropped, as it would be
+    pruned anyway.
+
+    Storing reports again does no harm: the statistics of the machines
+    only count the reports that were not stored yet.
+    """
+    kept = []
+    for entry in entries:
+        machine = entry['report']['machine']
+        kept = [e for e in kept
+                if not (e['ticket_id'] == entry['ticket_id'] and
+                        e['report']['machine'] == machine and
+                        e['report']['status'] == 'Pending')]
+        kept.append(entry)
+
+    # before anything is stored
+    for entry in kept:
+        if entry['log'] and not os.path.exists(entry['path'] + '.log'):
+            raise IOError('missing log {}.log'.format(entry['path']))
+
+    tickets = {}
+    bases = {}  # ticket id -> bases of the added and removed reports
+    for entry in kept:
+        ticket_id = entry['ticket_id']
+        if ticket_id not in tickets:
+            ticket = db.tickets.find_one({'id': ticket_id})
+            if ticket is None:
+                ticket = scrape(ticket_id, db=db)
+            tickets[ticket_id] = ticket
+            bases[ticket_id] = set()
+    for entry in kept:
+        ticket_id = entry['ticket_id']
+        removed = db.prune_pending(tickets[ticket_id],
+                                   entry['report']['machine'])
+        bases[ticket_id].update(report['base'] for report in removed)
+        bases[ticket_id].add(entry['report']['base'])
+
+    new_reports = db.save_reports([(entry['ticket_id'], entry['report'])
+                                   for entry in kept])
+    for entry in kept:
+        if entry['log']:
+            data, log_index = index_log(entry)
+            db.save_log(db.log_name(entry['ticket_id'], entry['report']),
+                        data, compression=entry['compression'], **log_index)
+
+    for ticket in tickets.values():
+        fields = {'id': ticket['id'], 'last_activity': now_str()}
+        if 'retry' in ticket:
+            fields['retry'] = False
+        db.save_ticket(fields)
+        db.save_summary(ticket, bases[ticket['id']])
+    for ticket_id, report in new_reports:
+        db.save_machine_report(tickets[ticket_id], report)
+
+
+def index_log(entry):
+    """
+    Return the compressed log of an entry and the fields stored with it.
+
+    The positions of the blocks and plugin sections sent by the client
+    are kept if they fit in the log. Otherwise, as for the logs of older
+    clients, the log is compressed again in blocks and its plugin
+    sections are found here, so that ``serve.read_plugin_log`` does not
+    have to scan it.
+    """
+    compression = entry['compression']
+    with open(entry['path'] + '.log', 'rb') as f:
+        data = f.read()
+    log_index = entry['log_index']
+    if log_index.get('log_blocks') and index_fits(data, compression,
+                                                  log_index):
+        return data, log_index
+    try:
+        log = decompress_log(data, compression)
+    except Exception:
+        # not a log in this format, stored as it is
+        traceback.print_exc()
+        return data, {}
+    data, blocks = compress_log_blocks(log, compression)
+    return data, {'log_blocks': blocks, 'log_plugins': plugin_offsets(log)}
+
+
+def index_fits(data, compression, log_index):
+    """
+    Return whether the positions sent with a compressed log fit in it.
+
+    The blocks are known to follow each other, see
+    ``serve.check_log_index``, so that only the last one is decompressed
+    to find the size of the log.
+    """
+    start, compressed_start, length = log_index['log_blocks'][-1]
+    if compressed_start + length != len(data):
+        return False
+    try:
+        size = start + len(decompress_log(data[compressed_start:],
+                                          compression))
+    except Exception:
+        return False
+    return all(end <= size for _, _, end in log_index['log_plugins'])
+
+
+def release_entry(entry):
+    """
+    Put a claimed entry back in the spool.
+    """
+    os.rename(entry['path'] + '.claimed', entry['path'] + '.json')
+
+
+def retry_later(entry):
+    """
+    Put a claimed entry back in the spool, to be tried again after
+    ``RETRY_DELAY`` seconds, or set it aside after ``MAX_ATTEMPTS``
+    attempts.
+    """
+    entry['attempts'] = entry.get('attempts', 0) + 1
+    if entry['attempts'] >= MAX_ATTEMPTS:
+        set_aside(entry)
+        return
+    path = entry['path']
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict((key, value) for key, value in entry.items()
+                       if key != 'path'), f)
+    # still claimed while it is rewritten
+    os.rename(path + '.tmp', path + '.claimed')
+    _retry_after[path] = time.time() + RETRY_DELAY
+    release_entry(entry)
+
+
+def remove_entry(entry):
+    for extension in ('.log', '.claimed'):
+        if os.path.exists(entry['path'] + extension):
+            os.remove(entry['path'] + extension)
+
+
+def set_aside(entry):
+    failed_dir = os.path.join(SPOOL_DIR, 'failed')
+    if not os.path.isdir(failed_dir):
+        os.makedirs(failed_dir)
+    name = os.path.basename(entry['path'])
+    if os.path.exists(entry['path'] + '.log'):
+        os.rename(entry['path'] + '.log',
+                  os.path.join(failed_dir, name + '.log'))
+    os.rename(entry['path'] + '.claimed',
+              os.path.join(failed_dir, name + '.json'))
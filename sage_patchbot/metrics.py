@@ -0,0 +1,154 @@
+"""
+Metrics of the patchbot server, served in the text format of Prometheus.
+
+The metrics are kept by each server process, see ``serve.metrics``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from .timed_cache import cache_stats
+
+# upper bounds of the buckets of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# all the metrics, in the order they are rendered
+REGISTRY = []
+
+
+def format_labels(names, values):
+    def escape(value):
+        return (str(value).replace('\\', r'\\').replace('"', r'\"')
+                .replace('\n', r'\n'))
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter(object):
+    """
+    A count for every value of the labels.
+    """
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append('{}{} {}'.format(
+                self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram(object):
+    """
+    The distribution of some durations, for every value of the labels.
+    """
+    def __init__(self, name, doc, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        # label values -> [count in each bucket, sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((labels, list(values))
+                            for labels, values in self._series.items())
+        names = self.labelnames + ('le',)
+        for labels, values in series:
+            cumulated = 0
+            for bound, count in zip(self.buckets, values):
+                cumulated += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(names, labels + (bound,)),
+                    cumulated))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, format_labels(names, labels + ('+Inf',)),
+                values[-1]))
+            label_str = format_labels(self.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str,
+                                              values[-2]))
+            lines.append('{}_count{} {}'.format(self.name, label_str,
+                                                values[-1]))
+        return lines
+
+
+REQUESTS = Counter('patchbot_requests_total',
+                   'Requests answered, by route, method and status.',
+                   ['route', 'method', 'status'])
+
+REQUEST_SECONDS = Histogram('patchbot_request_duration_seconds',
+                            'Time until the answer to a request starts '
+                            'being sent, by route and method.',
+                            ['route', 'method'])
+
+MONGO_SECONDS = Histogram('patchbot_mongo_command_duration_seconds',
+                          'Time of the commands sent to mongodb, by command '
+                          'and collection (logs.chunks for GridFS reads).',
+                          ['command', 'collection'])
+
+TRAC_SECONDS = Histogram('patchbot_trac_call_duration_seconds',
+                         'Time of the calls to trac made by scrape, by call.',
+                         ['call'])
+
+
+def render():
+    """
+    Return all the metrics in the text format of Prometheus.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    caches = sorted(cache_stats().items())
+    for key, kind, doc in [('hits', 'counter', 'Hits of the cache.'),
+                           ('misses', 'counter', 'Misses of the cache.'),
+                           ('size', 'gauge', 'Values in the cache.')]:
+        name = 'patchbot_cache_{}'.format(key)
+        if kind == 'counter':
+            name += '_total'
+        lines.append('# HELP {} {}'.format(name, doc))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for cache, stats in caches:
+            lines.append('{}{} {}'.format(
+                name, format_labels(('cache',), (cache,)), stats[key]))
+    return '\n'.join(lines) + '\n'
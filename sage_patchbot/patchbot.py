@@ -37,11 +37,11 @@ import subprocess
 import time
 import traceback
 import tempfile
-import bz2
 import json
 import socket
 import pprint
 import multiprocessing
+import zlib
 
 # from six.moves import cPickle as pickle
 try:
@@ -50,21 +50,27 @@ except ImportError:
     import pickle  # python3
 
 try:
-    from urllib2 import urlopen, HTTPError  # python2
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from urllib2 import urlopen, Request, HTTPError, URLError  # python2
     from urllib import urlencode
 except ImportError:
-    from urllib.request import urlopen  # python3
-    from urllib.error import HTTPError
+    from urllib.request import urlopen, Request  # python3
+    from urllib.error import HTTPError, URLError
     from urllib.parse import urlencode
 
 from datetime import datetime
 
 # imports from patchbot sources
 from .trac import get_ticket_info_from_trac_server, pull_from_trac, TracServer, Config, is_closed_on_trac
-from .util import (now_str, prune_pending, do_or_die,
+from .util import (now_str, do_or_die,
                    get_sage_version, current_reports, git_commit,
                    describe_branch, comparable_version, temp_build_suffix,
-                   ensure_free_space,
+                   ensure_free_space, compress_log_blocks, plugin_offsets,
+                   available_log_compressions,
                    ConfigException, SkipTicket, TestsFailed)
 from .http_post_file import post_multipart
 from .plugins import PluginResult, plugins_available
@@ -77,6 +83,12 @@ LOG_MAIN = ('patchbot.log', sys.stdout)
 LOG_MAIN_SHORT = 'history.txt'
 LOG_CONFIG = 'config.txt'
 
+# encodings of the answers of the server we can decode
+ACCEPT_ENCODING = 'br, gzip' if brotli is not None else 'gzip'
+
+# number of queued reports sent together, see ``Patchbot.flush_reports``
+REPORT_BULK_SIZE = 20
+
 
 def filter_on_authors(tickets, authors):
     """
@@ -237,6 +249,19 @@ def boundary(name, text_type):
     return ' '.join((letter * length, str(name), letter * length))
 
 
+def decode_response(data, encoding=None):
+    """
+    Decompress the bytes of an answer of the server and decode them.
+
+    ``encoding`` is the Content-Encoding of the answer.
+    """
+    if encoding == 'gzip':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif encoding == 'br':
+        data = brotli.decompress(data)
+    return data.decode('utf8')
+
+
 def machine_data():
     """
     Return the machine data as a list of strings.
@@ -409,6 +434,7 @@ class Patchbot(object):
                       "max_behind_commits": 0,
                       "max_behind_days": 1.0,
                       "use_ccache": True,
+                      "log_compression": "gzip",  # or bz2, zstd
                       # 6 options that can also be changed using sage --xx
                       "dry_run": False,
                       "no_banner": False,
@@ -441,6 +467,7 @@ class Patchbot(object):
         self.last_pull = 0
         self.to_skip = {}
         self.idling = False
+        self.ticket_table = None
 
         self.write_log('Patchbot {} initialized with SAGE_ROOT={} (pid: {})'.format(
             self.__version__, self.sage_root, os.getpid()), LOG_MAIN)
@@ -554,14 +581,35 @@ class Patchbot(object):
         - ``path`` -- the query for the server
 
         - ``retry`` -- the number of times we retry to get a connection
+
+        The last answer of the server is kept on disk with its ETag. If
+        the server says that it has not changed, it is used again.
+
+        A 404 answer is not retried.
         """
+        cached = self.load_server_cache(path)
         while True:
             retry -= 1
             try:
                 ad = "{}/{}".format(self.server, path)
-                full_str = urlopen(ad, timeout=10).read().decode('utf8')
+                req = Request(ad)
+                req.add_header('Accept-Encoding', ACCEPT_ENCODING)
+                if cached is not None:
+                    req.add_header('If-None-Match', cached['etag'])
+                handle = urlopen(req, timeout=10)
+                full_str = decode_response(handle.read(),
+                                           handle.info().get('Content-Encoding'))
+                etag = handle.info().get('ETag')
+                if etag:
+                    self.save_server_cache(path, etag, full_str)
                 return json.loads(full_str)
             except HTTPError as err:
+                if err.code == 304 and cached is not None:
+                    return json.loads(cached['payload'])
+                if err.code == 404:
+                    # asking again will not help, for instance a page
+                    # that an older server does not have
+                    raise
                 self.write_log(" retry {}; {}".format(retry, str(err)), [LOG_MAIN, LOG_MAIN_SHORT])
                 if retry == 0:
                     raise
@@ -574,6 +622,35 @@ class Patchbot(object):
 
             time.sleep(30)
 
+    def server_cache_path(self, path):
+        """
+        Return the file where the answer of the server to ``path`` is kept.
+        """
+        name = hashlib.md5(path.encode('utf8')).hexdigest() + '.json'
+        return os.path.join(self.log_dir, 'server_cache', name)
+
+    def load_server_cache(self, path):
+        """
+        Return the last answer of the server to ``path`` as a dict
+        with keys ``etag`` and ``payload``, or ``None``.
+        """
+        try:
+            with open(self.server_cache_path(path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_server_cache(self, path, etag, payload):
+        """
+        Keep the answer of the server to ``path`` with its ETag.
+        """
+        cache_path = self.server_cache_path(path)
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump({'etag': etag, 'payload': payload}, f)
+        os.rename(cache_path + '.tmp', cache_path)
+
     def default_trusted_authors(self):
         """
         Define the default trusted authors.
@@ -793,7 +870,11 @@ class Patchbot(object):
             s = ', '.join('#{} (until {})'.format(k, v)
                           for k, v in self.to_skip.items())
             self.write_log('The following tickets will be skipped: ' + s, LOG_MAIN)
-        all_tickets = self.load_json_from_server("ticket/?" + query, retry=10)
+        if status == 'open' and self.ticket_table is not False:
+            all_tickets = self.load_ticket_table()
+        else:
+            all_tickets = self.load_json_from_server("ticket/?" + query,
+                                                     retry=10)
 
         # rating for all tickets
         self.delete_log(LOG_RATING)
@@ -822,6 +903,47 @@ class Patchbot(object):
         else:
             return None
 
+    def load_ticket_table(self):
+        """
+        Return the list of open tickets.
+
+        The tickets are kept in the attribute ``ticket_table`` (a dict
+        ticket id -> ticket) and only the tickets that changed since the
+        previous call are asked to the patchbot server. The whole table
+        is downloaded again once a day.
+
+        If the server cannot send the changes, ``ticket_table`` is set to
+        ``False`` and the full ticket list is used instead.
+        """
+        now = time.time()
+        try:
+            if (not self.ticket_table or
+                    now - self.ticket_table_loaded > 24 * 60 * 60):
+                data = self.load_json_from_server("ticket/changes?status=open",
+                                                  retry=10)
+                self.ticket_table = {}
+                self.ticket_table_loaded = now
+            else:
+                path = "ticket/changes?" + urlencode({'since':
+                                                      self.ticket_table_time})
+                data = self.load_json_from_server(path, retry=10)
+        except HTTPError as err:
+            if err.code != 404:
+                raise
+            self.ticket_table = False
+            return self.load_json_from_server("ticket/?raw&status=open",
+                                              retry=10)
+
+        open_status = re.compile('needs_.*|positive_review')
+        for ticket in data['tickets']:
+            if (open_status.search(ticket['status']) and
+                    ticket.get('milestone') != 'sage-duplicate/invalid/wontfix'):
+                self.ticket_table[ticket['id']] = ticket
+            else:
+                self.ticket_table.pop(ticket['id'], None)
+        self.ticket_table_time = data['time']
+        return list(self.ticket_table.values())
+
     def rate_ticket(self, ticket, verbose=False):
         """
         Evaluate the interest to test this ticket.
@@ -913,8 +1035,6 @@ class Patchbot(object):
                                       ticket['priority'], ticket['id']),
                            logfile, False)
 
-            prune_pending(ticket)
-
             retry = ticket.get('retry', False)
             # by default, do not retry the ticket
 
@@ -1425,19 +1545,176 @@ class Patchbot(object):
         print("REPORT")
         pprint.pprint(report)
         print("{}: {}".format(ticket['id'], status))
-        fields = {'report': json.dumps(report)}
+        compression = self.log_compression()
+        fields = {'report': json.dumps(report),
+                  'log_compression': compression}
         if os.path.exists(log):
             # py3 : opens the file, get bytes
             # py2 : opens the file, get str=bytes
             local_log = open(log, 'rb').read()
-            compressed = bz2.compress(local_log)
+            compressed, blocks = compress_log_blocks(local_log, compression)
+            # lets the server read a part of the log without the rest
+            fields['log_index'] = json.dumps({'blocks': blocks,
+                                              'plugins': plugin_offsets(local_log)})
             files = [('log', 'log', compressed)]
         else:
             files = []
         if not dry_run or status == 'Pending':
+            if not self.post_report(ticket['id'], fields, files):
+                # the server cannot be reached, a pending report would be
+                # outdated when sent later
+                if status != 'Pending':
+                    self.queue_report(ticket['id'], fields, files)
+
+    def log_compression(self):
+        """
+        Return the compression format of the logs sent to the server.
+
+        This is the configured ``log_compression`` if both the server
+        (see ``serve.log_compressions``) and this client support it, and
+        bz2 otherwise, which every server reads.
+        """
+        wanted = self.config['log_compression']
+        if wanted == 'bz2' or wanted not in available_log_compressions():
+            return 'bz2'
+        if getattr(self, '_server_log_compressions', None) is None:
+            try:
+                self._server_log_compressions = self.load_json_from_server("log_compressions")
+            except HTTPError as err:
+                if err.code != 404:
+                    return 'bz2'
+                # an older server
+                self._server_log_compressions = ['bz2']
+            except Exception:
+                # ask again for the next report
+                return 'bz2'
+        if wanted in self._server_log_compressions:
+            return wanted
+        return 'bz2'
+
+    def post_report(self, ticket_id, fields, files):
+        """
+        Send a report to the patchbot server.
+
+        Return ``False`` if the server could not be reached, and ``True``
+        otherwise (even if the server refused the report).
+        """
+        try:
             print(post_multipart("{}/report/{}".format(self.server,
-                                                       ticket['id']),
+                                                       ticket_id),
                                  fields, files))
+        except HTTPError as err:
+            if err.code >= 500:
+                self.write_log("#{}: cannot post the report; {}".format(ticket_id, err),
+                               [LOG_MAIN, LOG_MAIN_SHORT])
+                return False
+            # the server refused the report
+            self.write_log("#{}: {}".format(ticket_id,
+                                            err.read().decode('utf8')),
+                           [LOG_MAIN, LOG_MAIN_SHORT])
+        except (URLError, socket.error) as err:
+            self.write_log("#{}: cannot post the report; {}".format(ticket_id, err),
+                           [LOG_MAIN, LOG_MAIN_SHORT])
+            return False
+        return True
+
+    def report_queue_dir(self):
+        return os.path.join(self.log_dir, 'report_queue')
+
+    def queue_report(self, ticket_id, fields, files):
+        """
+        Keep a report that could not be sent, see ``flush_reports``.
+        """
+        queue_dir = self.report_queue_dir()
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        path = os.path.join(queue_dir, '{:017d}-{}'.format(
+            int(time.time() * 1e6), ticket_id))
+        for key, filename, value in files:
+            with open(path + '.log', 'wb') as f:
+                f.write(value)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'ticket_id': ticket_id, 'fields': fields}, f)
+        os.rename(path + '.tmp', path + '.json')
+        self.write_log("#{}: report queued".format(ticket_id),
+                       [LOG_MAIN, LOG_MAIN_SHORT])
+
+    def flush_reports(self):
+        """
+        Send the queued reports to the patchbot server.
+
+        They are sent by groups of ``REPORT_BULK_SIZE`` reports. If the
+        server does not accept a group, its reports are sent one by one.
+
+        Return the number of reports still in the queue.
+        """
+        queue_dir = self.report_queue_dir()
+        if not os.path.isdir(queue_dir):
+            return 0
+        paths = sorted(os.path.join(queue_dir, filename[:-len('.json')])
+                       for filename in os.listdir(queue_dir)
+                       if filename.endswith('.json'))
+        while paths:
+            group = paths[:REPORT_BULK_SIZE]
+            entries = []
+            for path in group:
+                with open(path + '.json') as f:
+                    entry = json.load(f)
+                if os.path.exists(path + '.log'):
+                    with open(path + '.log', 'rb') as f:
+                        entry['log'] = f.read()
+                else:
+                    entry['log'] = None
+                entries.append(entry)
+
+            items = []
+            files = []
+            for i, entry in enumerate(entries):
+                fields = entry['fields']
+                item = {'ticket_id': entry['ticket_id'],
+                        'report': json.loads(fields['report']),
+                        'log_compression': fields['log_compression'],
+                        'log_index': None,
+                        'log': None}
+                if 'log_index' in fields:
+                    item['log_index'] = json.loads(fields['log_index'])
+                if entry['log'] is not None:
+                    item['log'] = 'log{}'.format(i)
+                    files.append((item['log'], 'log', entry['log']))
+                items.append(item)
+
+            try:
+                print(post_multipart("{}/reports/bulk".format(self.server),
+                                     {'reports': json.dumps(items)}, files))
+            except HTTPError as err:
+                if err.code >= 500:
+                    self.write_log("cannot flush the reports; {}".format(err),
+                                   [LOG_MAIN, LOG_MAIN_SHORT])
+                    return len(paths)
+                # an older server, or some report was refused
+                for path, entry in zip(group, entries):
+                    files = []
+                    if entry['log'] is not None:
+                        files = [('log', 'log', entry['log'])]
+                    if not self.post_report(entry['ticket_id'],
+                                            entry['fields'], files):
+                        return len(paths)
+                    self.remove_queued_report(path)
+                    paths.remove(path)
+                continue
+            except (URLError, socket.error) as err:
+                self.write_log("cannot flush the reports; {}".format(err),
+                               [LOG_MAIN, LOG_MAIN_SHORT])
+                return len(paths)
+            for path in group:
+                self.remove_queued_report(path)
+            paths = paths[len(group):]
+        return 0
+
+    def remove_queued_report(self, path):
+        for extension in ('.log', '.json'):
+            if os.path.exists(path + extension):
+                os.remove(path + extension)
 
     def git_commit(self, branch):
         return git_commit(self.sage_root, branch)
@@ -1506,6 +1783,9 @@ def main(args=None):
     parser.add_option("--ticket", dest="ticket",
                       help="test only a list of tickets, for example"
                            " '12345,19876'")
+    parser.add_option("--flush", action="store_true", dest="flush",
+                      help="send the reports that could not be sent "
+                           "earlier and quit")
     parser.add_option("--free-giga", dest="free_giga",
                       type="float", default=4,
                       help="number of required free gigabytes (0 means "
@@ -1537,6 +1817,10 @@ def main(args=None):
         print(pprint.pprint(patchbot.config))
         sys.exit(0)
 
+    if options.flush:
+        # the option "--flush" sends the queued reports
+        sys.exit(1 if patchbot.flush_reports() else 0)
+
     if options.list:
         # the option "--list" allows to see tickets that will be tested
         patchbot.get_one_ticket(verbose=1)
@@ -1608,6 +1892,7 @@ def main(args=None):
             ticket = tickets.pop(0)
 
         try:
+            patchbot.flush_reports()
             patchbot.test_a_ticket(ticket)
         except Exception:
             traceback.print_exc()
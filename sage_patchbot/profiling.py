@@ -0,0 +1,116 @@
+"""
+Opt-in profiling of the requests to the patchbot server.
+
+Profiling is enabled with the environment variables
+
+- ``PATCHBOT_PROFILE_EVERY`` -- keep the profile of one request out of
+  this many
+
+- ``PATCHBOT_PROFILE_SLOWER`` -- keep the profile of every request
+  slower than this many seconds (all requests are then profiled, but
+  only the slow ones are kept)
+
+The profiles are written by cProfile in ``PATCHBOT_PROFILE_DIR``, next
+to a json file with the route, the arguments and the duration of the
+request. See ``serve.debug_profiles`` for their listing.
+"""
+import cProfile
+import itertools
+import json
+import os
+import threading
+import time
+
+PROFILE_DIR = os.environ.get('PATCHBOT_PROFILE_DIR',
+                             '/home/patchbot/profiles')
+PROFILE_EVERY = int(os.environ.get('PATCHBOT_PROFILE_EVERY', 0))
+PROFILE_SLOWER = float(os.environ.get('PATCHBOT_PROFILE_SLOWER', 0))
+
+# older profiles are removed
+MAX_PROFILES = 200
+
+_requests = itertools.count()
+_save_lock = threading.Lock()
+
+
+def enabled():
+    return PROFILE_EVERY > 0 or PROFILE_SLOWER > 0
+
+
+def start():
+    """
+    Start profiling the current request if it has to be.
+
+    Return a pair (profile, sampled), or ``None`` when the request is not
+    profiled.
+    """
+    sampled = PROFILE_EVERY > 0 and next(_requests) % PROFILE_EVERY == 0
+    if not sampled and PROFILE_SLOWER <= 0:
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another request of this process is being profiled
+        return None
+    return profile, sampled
+
+
+def finish(state, info, duration):
+    """
+    Stop profiling a request and keep its profile if it has to be.
+
+    ``info`` is a dictionary describing the request.
+    """
+    profile, sampled = state
+    profile.disable()
+    slow = PROFILE_SLOWER > 0 and duration >= PROFILE_SLOWER
+    if not (sampled or slow):
+        return
+    info = dict(info, duration=duration,
+                time=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+                reason='slow' if slow else 'sampled')
+    with _save_lock:
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        name = '{:017d}-{}'.format(int(time.time() * 1e6), os.getpid())
+        path = os.path.join(PROFILE_DIR, name)
+        profile.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as f:
+            json.dump(info, f)
+        for old in list_profiles()[MAX_PROFILES:]:
+            for extension in ('.json', '.prof'):
+                old_path = os.path.join(PROFILE_DIR, old['name'] + extension)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+
+def list_profiles():
+    """
+    Return the descriptions of the kept profiles, newest first.
+
+    Each of them has the name of its profile in ``name``.
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(PROFILE_DIR, filename)) as f:
+                    info = json.load(f)
+            except (IOError, ValueError):
+                continue
+            info['name'] = filename[:-len('.json')]
+            profiles.append(info)
+    return profiles
+
+
+def profile_path(name):
+    """
+    Return the path of the profile with this name, or ``None``.
+    """
+    if not name.replace('-', '').isdigit():
+        return None
+    path = os.path.join(PROFILE_DIR, name + '.prof')
+    return path if os.path.exists(path) else None
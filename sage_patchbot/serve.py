@@ -3,16 +3,17 @@
 from __future__ import absolute_import
 import os
 import sys
-import bz2
+import codecs
 import json
+import hashlib
 import traceback
 import re
-import collections
 import time
 import difflib
+import pstats
+import zlib
 from optparse import OptionParser
-from flask import Flask, render_template, make_response, request, Response
-from datetime import datetime
+from flask import Flask, render_template, make_response, request, Response, g
 
 # from six.moves import cStringIO
 try:
@@ -21,18 +22,30 @@ except ImportError:
     from io import StringIO  # python3
 
 try:
-    from urllib import quote
+    import brotli
 except ImportError:
-    from urllib.parse import quote
+    brotli = None
+
+try:
+    from urllib import quote, urlencode
+except ImportError:
+    from urllib.parse import quote, urlencode
 
 # imports from patchbot sources
 from .trac import scrape
-from .util import (now_str, current_reports, latest_version,
-                   comparable_version, date_parser)
+from .util import (now_str, current_reports,
+                   comparable_version, date_parser, DATE_FORMAT,
+                   status_order, min_status, get_ticket_status,
+                   available_log_compressions,
+                   log_decompressor)
 from .patchbot import filter_on_authors
+from .timed_cache import timed_cached_function
 
 from . import db
-from .db import tickets
+from . import ingest
+from . import metrics
+from . import profiling
+from .db import tickets, log_name
 
 IMAGES_DIR = '/home/patchbot/sage-patchbot/sage_patchbot/images/'
 
@@ -43,37 +56,148 @@ IMAGES_DIR = '/home/patchbot/sage-patchbot/sage_patchbot/images/'
 # machines that are banned from posting their reports
 BLACKLIST = []
 
+# set when the tickets are kept up to date by ``trac_sync``: trac is
+# then only contacted to answer requests with ?force
+TRAC_SYNC = bool(os.environ.get('PATCHBOT_TRAC_SYNC'))
 
-def timed_cached_function(refresh_rate=60):
+# size of the pieces in which logs are read from the database
+LOG_CHUNK_SIZE = 2 ** 16
 
-    def decorator(func):
-        cache = {}
+# order of the ticket lists, newest trac activity first, see ``page_query``
+TICKET_ORDER = [('last_trac_activity', -1), ('id', -1)]
 
-        def wrap(*args):
-            now = time.time()
-            if args in cache:
-                latest_update, res = cache[args]
-                if now - latest_update < refresh_rate:
-                    return res
-            res = func(*args)
-            cache[args] = now, res
-            return res
-        return wrap
-    return decorator
+# responses that are compressed when the client accepts it, if larger
+# than COMPRESS_MIN_SIZE bytes, see ``compress_response``
+COMPRESS_TYPES = ('text/', 'application/json', 'image/svg+xml')
+COMPRESS_MIN_SIZE = 500
 
+# SQLite file through which the worker processes of the server share
+# their cached computations, see ``timed_cached_function``
+CACHE_DB = os.environ.get('PATCHBOT_CACHE_DB')
 
-@timed_cached_function()
+
+@timed_cached_function(shared=CACHE_DB)
 def latest_base(betas=True):
-    versions = list(tickets.find({'id': 0}).distinct('reports.base'))
+    versions = db.lookup_bases()
     if not betas:
         versions = list(filter(re.compile(r'[0-9.]+$').match, versions))
-    versions.sort(key=comparable_version)
     return versions[-1]
 
 app = Flask(__name__)
 
 
-def compute_trusted_authors():
+@app.before_request
+def start_timer():
+    g.start_time = time.time()
+    if profiling.enabled():
+        g.profile = profiling.start()
+
+
+@app.after_request
+def record_metrics(response):
+    """
+    Count the request and record its duration, see ``metrics``.
+
+    For a streamed response, this is the time until it starts.
+    """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUESTS.inc(route, request.method, str(response.status_code))
+    if 'start_time' in g:
+        metrics.REQUEST_SECONDS.observe(time.time() - g.start_time,
+                                        route, request.method)
+    return response
+
+
+@app.after_request
+def finish_profile(response):
+    """
+    Keep the profile of the request once it is answered, see ``profiling``.
+    """
+    state = g.get('profile')
+    if state is not None:
+        info = {'route': request.url_rule.rule if request.url_rule else None,
+                'method': request.method,
+                'url': request.full_path,
+                'args': request.args.to_dict(flat=False),
+                'status': response.status_code}
+        start_time = g.start_time
+        # a streamed response is profiled until it is fully sent
+        response.call_on_close(lambda: profiling.finish(
+            state, info, time.time() - start_time))
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress the response with brotli or gzip if the client accepts it.
+
+    Streamed responses are compressed while they are sent. The ETag of a
+    compressed response is made weak, as its bytes differ from those of
+    the identity encoding.
+    """
+    if (response.status_code != 200 or
+            'Content-Encoding' in response.headers or
+            not response.mimetype.startswith(COMPRESS_TYPES)):
+        return response
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compressed_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = response_compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+class BrotliCompressor(object):
+    """
+    The interface of ``zlib.compressobj`` for brotli.
+    """
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def response_compressor(encoding):
+    if encoding == 'br':
+        return BrotliCompressor()
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compressed_stream(chunks, encoding):
+    """
+    Compress the chunks of a streamed response as they come.
+    """
+    compressor = response_compressor(encoding)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compute_trusted_authors(authors=None):
     """
     Define the trusted authors.
 
@@ -82,16 +206,26 @@ def compute_trusted_authors():
 
     The result is a dict, its keys being the trusted authors.
 
+    The counts are maintained by ``db.save_ticket``, see
+    ``db.fixed_authors``. If ``authors`` is given, only these authors
+    are looked up.
+
     This needs work ! We cannot rely on the branch names!
     """
-    authors = collections.defaultdict(int)
-    for ticket in tickets.find({'status': 'closed', 'resolution': 'fixed',
-                                'milestone': {'$ne': 'sage-duplicate/invalid/wontfix'}}):
-        for author in ticket.get("authors_fullnames", []):
-            a = author.strip()
-            if a and a != '<no author>':
-                authors[a] += 1
-    return authors
+    return db.lookup_trusted_authors(authors)
+
+
+@app.route("/log_compressions")
+def log_compressions():
+    """
+    Serve the json list of the compression formats of the logs that
+    this server reads.
+
+    Clients check it before sending logs in another format than bz2.
+    """
+    response = make_response(json.dumps(available_log_compressions()))
+    response.headers['Content-type'] = 'text/plain; charset=utf-8'
+    return response
 
 
 @app.route("/trusted")
@@ -107,6 +241,9 @@ def trusted_authors():
     and https://patchbot.sagemath.org/trusted/?pretty
 
     The dict of trusted authors is computed in ``compute_trusted_authors``.
+
+    The response carries an ETag, so that clients asking again with
+    If-None-Match get an empty 304 answer when nothing changed.
     """
     authors = compute_trusted_authors()
     if 'pretty' in request.args:
@@ -114,9 +251,10 @@ def trusted_authors():
     else:
         indent = None
     response = make_response(json.dumps(authors, default=lambda x: None,
-                                        indent=indent))
+                                        indent=indent, sort_keys=True))
     response.headers['Content-type'] = 'text/plain; charset=utf-8'
-    return response
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route("/trust_check")
@@ -130,8 +268,8 @@ def trust_check():
 
     trust_check?who=balzac,zola
     """
-    authors = compute_trusted_authors()
     given_list = request.args['who'].split(',')
+    authors = compute_trusted_authors(given_list)
     trust_dict = {a: 'trusted' if a in authors else 'not trusted'
                   for a in given_list}
     response = make_response(json.dumps(trust_dict, default=lambda x: None,
@@ -180,18 +318,24 @@ def get_query(args):
         if 'participant' in args:
             query['participants'] = args.get('participant')
 
-        if 'machine' in args:
-            query['reports.machine'] = args['machine'].split(':')
-
         if 'ticket' in args:
             query['id'] = int(args['ticket'])
 
+        # conditions on the reports, that live in their own collection
+        report_query = {}
+        if 'machine' in args:
+            report_query['machine'] = args['machine'].split(':')
+
         if 'base' in args:
             base = args.get('base')
             if base == 'latest' or base == 'develop':
-                query['reports.base'] = latest_base()
+                report_query['base'] = latest_base()
             elif base != 'all':
-                query['reports.base'] = base
+                report_query['base'] = base
+
+        if report_query:
+            ticket_ids = db.reports.distinct('ticket_id', report_query)
+            query['$and'] = [{'id': {'$in': ticket_ids}}]
 
     query['milestone'] = {'$ne': 'sage-duplicate/invalid/wontfix'}
 
@@ -221,55 +365,246 @@ def ticket_list():
     if 'authors' in request.args:
         authors = request.args.get('authors').split(':')
     limit = int(request.args.get('limit', 1000))
+    if 'after' in request.args:
+        try:
+            query = page_query(query, request.args['after'])
+        except ValueError:
+            return make_response("invalid cursor in after", 400)
     print(query)
+    next_page = next_page_url(query, limit)
 
-    order = ('last_trac_activity', -1)
-    cursor = tickets.find(query).sort(*order).limit(limit)
-    all = filter_on_authors(cursor, authors)
     if 'raw' in request.args:
         # raw json file for communication with patchbot clients
 
-        def filter_reports(all):
-            for ticket in all:
-                current = sorted(current_reports(ticket),
-                                 key=lambda report: report['time'])
-                ticket['reports'] = list(reversed(current))[:10]
-                for report in ticket['reports']:
-                    report['plugins'] = '...'
-                yield ticket
+        # nothing to send if the client already has the current version
+        etag = feed_etag(query, request.args)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+
+        cursor = tickets.find(query).sort(TICKET_ORDER).limit(limit)
+        all = db.with_reports(filter_on_authors(cursor, authors))
         all = filter_reports(all)
         if 'pretty' in request.args:
             indent = 4
         else:
             indent = None
-        response = make_response(json.dumps(list(all), default=lambda x: None,
-                                            indent=indent))
+        # the tickets are serialized one by one while they are sent
+        response = Response(json_stream(all, indent=indent),
+                            direct_passthrough=True)
         response.headers['Content-type'] = 'text/plain; charset=utf-8'
+        if next_page is not None:
+            response.headers['Link'] = '<{}>; rel="next"'.format(next_page)
+        response.set_etag(etag)
         return response
 
+    # the status of the tickets is read from the summaries, so that the
+    # reports are only needed to filter on a machine
+    cursor = tickets.find(query).sort(TICKET_ORDER).limit(limit)
+    all = list(filter_on_authors(cursor, authors))
+    if machine is not None:
+        all = list(db.with_reports(all))
+    ticket_summaries = db.lookup_summaries([t['id'] for t in all],
+                                           base or 'latest')
+
     summary = {key: 0 for key in status_order}
 
     def preprocess(all):
         for ticket in all:
-            ticket['report_count'], ticket['report_status'], ticket['report_status_composite'] = get_ticket_status(ticket, machine=machine, base=base or 'latest')
-            if 'reports' in ticket:
-                ticket['pending'] = len([r for r in ticket['reports']
+            if machine is None:
+                status = summary_status(ticket, ticket_summaries.get(ticket['id']),
+                                        base=base or 'latest')
+                ticket['pending'] = ticket_summaries.get(ticket['id'],
+                                                         {}).get('pending', 0)
+            else:
+                status = get_ticket_status(ticket, machine=machine,
+                                           base=base or 'latest')
+                ticket['pending'] = len([r for r in ticket.get('reports', [])
                                          if r['status'] == 'Pending'])
+            ticket['report_count'], ticket['report_status'], ticket['report_status_composite'] = status
             summary[ticket['report_status']] += 1
             yield ticket
 
     ticket0 = tickets.find_one({'id': 0})
-    base_status = get_ticket_status(ticket0, base)
-    versions = list(set(report['base'] for report in ticket0['reports']))
-    versions.sort(key=comparable_version)
+    base_summaries = {s['base']: s
+                      for s in db.summaries.find({'ticket_id': 0})}
+    base_status = summary_status(ticket0, base_summaries.get(base or 'all'))
+    versions = db.lookup_bases()
     master_branch = comparable_version([v for v in versions
                                         if len(v.split('.')) == 2][-1])
     versions = [v for v in versions if comparable_version(v) >= master_branch]
-    versions = [(v, get_ticket_status(ticket0, v)) for v in versions]
+    versions = [(v, summary_status(ticket0, base_summaries.get(v), base=v))
+                for v in versions]
 
     return render_template("ticket_list.html", tickets=preprocess(all),
                            summary=summary, base=base, base_status=base_status,
-                           versions=versions, status_order=status_order)
+                           versions=versions, status_order=status_order,
+                           next_page=next_page)
+
+
+@app.route("/ticket/changes")
+def ticket_changes():
+    """
+    Serve the tickets that changed since a given time, as raw json.
+
+    This is for patchbot clients that keep their own table of tickets.
+
+    The time is given as ``?since=2017-03-21 10:05:00`` and compared with
+    the ``last_activity`` of the tickets, which changes with the ticket
+    metadata and with its reports. Without ``since``, the tickets are
+    selected by the usual arguments (``status``, ...).
+
+    The result is a json dict with keys ``time`` (the value of ``since``
+    for the next request) and ``tickets`` (in the format of the raw
+    ticket list).
+    """
+    now = now_str()
+    if 'since' in request.args:
+        try:
+            # the times of the database are compared as strings
+            since = date_parser(request.args['since']).strftime(DATE_FORMAT)
+        except ValueError:
+            return make_response("invalid time in since", 400)
+        # tickets changed during the second ``since`` are sent again
+        query = {'last_activity': {'$gte': since}}
+    else:
+        query = get_query(request.args)
+    if 'pretty' in request.args:
+        indent = 4
+    else:
+        indent = None
+    cursor = tickets.find(query).sort('last_activity', 1)
+    all = filter_reports(db.with_reports(cursor))
+
+    def body():
+        # bytes, as for ``json_stream``
+        yield ('{"time": %s, "tickets": ' % json.dumps(now)).encode('utf8')
+        for chunk in json_stream(all, indent=indent):
+            yield chunk
+        yield b'}'
+    response = Response(body(), direct_passthrough=True)
+    response.headers['Content-type'] = 'text/plain; charset=utf-8'
+    return response
+
+
+def filter_reports(all):
+    """
+    Prepare tickets for the raw json feed.
+
+    Only the 10 newest current reports are kept, without plugin data.
+    """
+    for ticket in all:
+        current = sorted(current_reports(ticket),
+                         key=lambda report: report['time'])
+        ticket['reports'] = list(reversed(current))[:10]
+        for report in ticket['reports']:
+            report['plugins'] = '...'
+        yield ticket
+
+
+def page_query(query, after):
+    """
+    Restrict ``query`` to the tickets coming after a cursor in the order
+    ``TICKET_ORDER``.
+
+    The cursor ``after`` is ``'<id>:<last_trac_activity>'`` for the last
+    ticket of the previous page, or just ``'<id>'`` if this ticket has no
+    ``last_trac_activity`` (such tickets come last), see
+    ``next_page_url``.
+
+    A malformed cursor raises a ``ValueError``.
+    """
+    if ':' in after:
+        ticket_id, activity = after.split(':', 1)
+        condition = {'$or': [{'last_trac_activity': {'$lt': activity}},
+                             {'last_trac_activity': activity,
+                              'id': {'$lt': int(ticket_id)}},
+                             {'last_trac_activity': None}]}
+    else:
+        condition = {'last_trac_activity': None, 'id': {'$lt': int(after)}}
+    query = dict(query)
+    query['$and'] = query.get('$and', []) + [condition]
+    return query
+
+
+def next_page_url(query, limit):
+    """
+    Return the url of the page of tickets following the first ``limit``
+    tickets matching ``query``, or ``None`` if there are no more tickets.
+
+    The url is the current one, with the cursor in the argument ``after``.
+    """
+    if limit <= 0:
+        return None
+    fields = {'id': True, 'last_trac_activity': True}
+    last = list(tickets.find(query, fields).sort(TICKET_ORDER)
+                .skip(limit - 1).limit(2))
+    if len(last) < 2:
+        return None
+    args = [(key, value) for key, value in request.args.items(multi=True)
+            if key != 'after']
+    if last[0].get('last_trac_activity') is None:
+        cursor = str(last[0]['id'])
+    else:
+        cursor = '{}:{}'.format(last[0]['id'], last[0]['last_trac_activity'])
+    args.append(('after', cursor))
+    return request.base_url + '?' + urlencode(args)
+
+
+def feed_etag(query, args):
+    """
+    Return a version token for the raw feed of the tickets matching ``query``.
+
+    This depends on the number of matching tickets and on their latest
+    ``last_activity``, which is updated whenever a ticket or its reports
+    change. The request arguments are included since they change the
+    content of the feed.
+    """
+    count, last_activity = db.feed_version(query)
+    token = json.dumps([sorted(args.items(multi=True)), count, last_activity])
+    return hashlib.md5(token.encode('utf8')).hexdigest()
+
+
+def json_stream(items, indent=None):
+    """
+    Serialize an iterable as a json list, one item at a time.
+
+    This is a generator of utf8-encoded bytes, to be used as the body of
+    a streamed response: the whole list is never held in memory. The
+    chunks are encoded here since ``direct_passthrough`` responses are
+    handed as such to the WSGI server.
+    """
+    separator = b',\n' if indent is not None else b','
+    yield b'['
+    for i, item in enumerate(items):
+        if i:
+            yield separator
+        yield json.dumps(item, default=lambda x: None,
+                         indent=indent).encode('utf8')
+    yield b']'
+
+
+def summary_status(ticket, summary, base=None):
+    """
+    Return the status triple of the ticket stored in its summary.
+
+    INPUT:
+
+    - ``ticket`` -- dictionary, used when there is no summary
+
+    - ``summary`` -- summary document for the given base or ``None``
+
+    - ``base`` -- keyword passed to ``get_ticket_status``
+
+    OUTPUT:
+
+    a triple (number of reports, single status, composite status)
+    """
+    if summary is None:
+        return get_ticket_status(ticket, base=base)
+    return (summary['report_count'], summary['report_status'],
+            summary['report_status_composite'])
 
 
 class MachineStats(object):
@@ -279,46 +614,69 @@ class MachineStats(object):
         self.all_tickets = set()
         self.report_count = 0
         self.last_report = ''
+        self.status_counts = {}
+
+    @classmethod
+    def from_document(cls, doc):
+        """
+        Build the statistics from a document of ``db.machines``.
+        """
+        stats = cls(tuple(doc['machine']))
+        stats.fresh_tickets = set(doc.get('fresh_tickets', []))
+        stats.all_tickets = set(doc.get('all_tickets', []))
+        stats.report_count = doc.get('report_count', 0)
+        stats.last_report = doc.get('last_report', '')
+        stats.status_counts = doc.get('status_counts', {})
+        return stats
 
-    def add_report(self, report, ticket):
-        self.report_count += 1
-        self.all_tickets.add(ticket['id'])
-        if report.get('git_commit') == ticket.get('git_commit'):
-            self.fresh_tickets.add(ticket['id'])
-        self.last_report = max(report['time'], self.last_report)
 
-    def __lt__(self, other):
-        return self.last_report < other.last_report
+# arguments of ``get_query`` that restrict the set of tickets
+TICKET_FILTERS = ('query', 'status', 'authors', 'author', 'participant',
+                  'machine', 'ticket', 'base')
 
 
 @app.route("/machines")
 def machines():
     """
     list of recently working machines, with some statistics
+
+    Without arguments, the statistics over all reports are read from
+    ``db.machines``. When the tickets are filtered, they are computed
+    by a mongo aggregation on the matching tickets.
     """
-    # aggregate requires server version >= 2.1.0
-    query = get_query(request.args)
-    if 'authors' in request.args:
-        authors = request.args.get('authors').split(':')
+    if any(arg in request.args for arg in TICKET_FILTERS):
+        # aggregate requires server version >= 2.1.0
+        query = get_query(request.args)
+        if 'authors' in request.args:
+            authors = request.args.get('authors').split(':')
+        else:
+            authors = None
+        docs = db.aggregate_machines(query, authors)
     else:
-        authors = None
-    all = filter_on_authors(tickets.find(query).limit(100), authors)
-    machines = {}
-    for ticket in all:
-        for report in ticket.get('reports', []):
-            machine = tuple(report['machine'])
-            if machine in machines:
-                stats = machines[machine]
-            else:
-                stats = machines[machine] = MachineStats(machine)
-            stats.add_report(report, ticket)
-    all = []
+        docs = db.machines.find().sort('last_report', -1)
     return render_template("machines.html",
-                           machines=reversed(sorted(machines.values())),
-                           len=len,
+                           machines=[MachineStats.from_document(doc)
+                                     for doc in docs],
+                           len=len, status_order=status_order,
                            status=request.args.get('status', 'needs_review'))
 
 
+def ticket_info(ticket, force=False, fast=False):
+    """
+    Return the info on a ticket from the database, or ``None``.
+
+    Unless ``fast`` is set or ``TRAC_SYNC`` is set, the info may be
+    refreshed from trac, see ``scrape``. With ``force``, it is always
+    refreshed.
+    """
+    if force or not (fast or TRAC_SYNC):
+        try:
+            return scrape(ticket, db=db, force=force, stale_ok=True)
+        except:
+            traceback.print_exc()
+    return tickets.find_one({'id': ticket})
+
+
 @app.route("/ticket/<int:ticket>/")
 def render_ticket(ticket):
     """
@@ -331,6 +689,8 @@ def render_ticket(ticket):
     ?kick will tell the patchbot-clients to retry the ticket
 
     ?base to select reports according to their base
+
+    ?skip and ?limit to display the reports page by page
     """
     latest = latest_base()
 
@@ -342,31 +702,24 @@ def render_ticket(ticket):
     if chosen_base == 'latest' or chosen_base == 'develop':
         chosen_base = latest
 
-    try:
-        info = scrape(ticket, db=db, force='force' in request.args)
-    except:
-        info = tickets.find_one({'id': ticket})
+    info = ticket_info(ticket, force='force' in request.args)
 
     if info is None:
         return "No such ticket."
     if 'kick' in request.args:
         info['retry'] = True
-        db.save_ticket(info)
+        info['last_activity'] = now_str()
+        db.save_ticket({'id': ticket, 'retry': True,
+                        'last_activity': info['last_activity']})
 
-    def sort_key(a):
-        return a['time']
-    if 'reports' in info:
-        info['reports'].sort(key=sort_key, reverse=True)
-    else:
-        info['reports'] = []
+    # newest first
+    info['reports'] = db.lookup_reports(
+        ticket, base=None if chosen_base == 'all' else chosen_base,
+        skip=int(request.args.get('skip', 0)),
+        limit=int(request.args.get('limit', 0)))
 
     base_reports = base_reports_by_machine_and_base()
 
-    old_reports = list(info['reports'])
-    prune_pending(info)
-    if old_reports != info['reports']:
-        db.save_ticket(info)
-
     def format_info(info):
         new_info = {}
         for key, value in info.items():
@@ -458,7 +811,8 @@ def render_ticket(ticket):
     def sort_fields(items):
         return sorted(items, key=(lambda x: (x[0] != 'title', x)))
 
-    status_data = get_ticket_status(info, base=latest)[1]  # single status
+    summary = db.lookup_summaries([ticket], latest).get(ticket)
+    status_data = summary_status(info, summary, base=latest)[1]  # single status
 
     return render_template("ticket.html",
                            reports=preprocess_reports(info['reports']),
@@ -468,12 +822,12 @@ def render_ticket(ticket):
                            sort_fields=sort_fields)
 
 
-@timed_cached_function(10)
+@timed_cached_function(10, shared=CACHE_DB)
 def base_reports_by_machine_and_base():
     """
     reports on the base branch (pseudo-ticket 0)
     """
-    return reports_by_machine_and_base(tickets.find_one({'id': 0}))
+    return reports_by_machine_and_base(db.load_reports({'id': 0}))
 
 
 def reports_by_machine_and_base(ticket):
@@ -500,43 +854,20 @@ def reports_by_machine_and_base(ticket):
 def render_ticket_base_svg(ticket):
     """
     Return the svg base version image for the given ticket.
+
+    This page is in the trac template, so that its requests keep the
+    ticket up to date: ``ticket_info`` is only called for this.
     """
-    try:
-        if 'fast' in request.args:
-            info = tickets.find_one({'id': ticket})
-        else:
-            info = scrape(ticket, db=db)
-    except:
-        info = tickets.find_one({'id': ticket})
+    ticket_info(ticket, fast='fast' in request.args)
 
     if 'base' in request.args:
         base = request.args.get('base')
     else:
-        base = latest_version(info.get('reports', []))
+        bases = db.report_bases(ticket)
+        base = max(bases, key=comparable_version) if bases else ''
 
-    if base is None:
-        base = ''
-
-    base = base.replace("alpha", u'α').replace("beta", u'β')
-    split_base = base.split('.')
-    if len(split_base) == 2:
-        v_main = base
-        v_sub = ''
-        baseline = 225
-    elif len(split_base) == 3:
-        x, y, z = split_base
-        v_main = x + '.' + y
-        v_sub = z
-        baseline = 150
-    else:
-        v_main = ''
-        v_sub = ''
-        baseline = 150
-    svg = render_template('icon-Version.svg', version_main=v_main,
-                          version_sub=v_sub, version_baseline=baseline)
-    response = make_response(svg)
-    response.content_type = 'image/svg+xml'
-    return response
+    return image_response(*version_badge(base), mimetype='image/svg+xml',
+                          cache_control='no-cache')
 
 
 @app.route("/ticket/<int:ticket>/status.svg")
@@ -546,107 +877,145 @@ def render_ticket_status_svg(ticket):
 
     This displays the current status (TestsPassed, etc) as an svg icon.
     """
-    try:
-        if 'fast' in request.args:
-            info = tickets.find_one({'id': ticket})
-        else:
-            info = scrape(ticket, db=db)
-    except:
-        info = tickets.find_one({'id': ticket})
-
-    if 'base' in request.args:
-        base = request.args.get('base')
-    else:
-        base = latest_version(info.get('reports', []))
+    info = ticket_info(ticket, fast='fast' in request.args)
 
-    status = get_ticket_status(info, base=base)[1]  # single status
-    path = status_image_path(status, image_type='svg')
+    base = request.args.get('base', 'latest')
+    summary = db.lookup_summaries([ticket], base).get(ticket)
+    status = summary_status(info, summary, base=base)[1]  # single status
 
     # with no base
-    response = make_response(open(path).read())
-    response.headers['Content-type'] = 'image/svg+xml'
-    response.headers['Cache-Control'] = 'no-cache'
-    return response
+    return image_response(*image_data(status_image_name(status, 'svg')),
+                          mimetype='image/svg+xml', cache_control='no-cache')
 
 
 @app.route("/report/<int:ticket_id>", methods=['POST'])
 def post_report(ticket_id):
     """
     Posting a report to the database of reports.
+
+    The report is only checked and put in the spool, it is stored in
+    the database in the background, see ``ingest``.
     """
+    form = request.form
     try:
-        ticket = tickets.find_one({'id': ticket_id})
-        if ticket is None:
-            ticket = scrape(ticket_id, db=db)
-        if 'reports' not in ticket:
-            ticket['reports'] = []
-        report = json.loads(request.form.get('report'))
-        assert (isinstance(report, dict)), "report is not a dict"
-        for fld in ['status', 'spkgs', 'base', 'machine', 'time']:
-            assert (fld in report), "{} missing in report".format(fld)
-
-        machine_name = report['machine'][-1]
-        if machine_name in BLACKLIST:
-            msg = 'machine {} is blacklisted'.format(machine_name)
-            raise RuntimeError(msg)
-
-        prune_pending(ticket, report['machine'])
-        ticket['reports'].append(report)
-        db.logs.put(request.files.get('log'), _id=log_name(ticket_id, report))
-        if 'retry' in ticket:
-            ticket['retry'] = False
-        ticket['last_activity'] = now_str()
-        db.save_ticket(ticket)
-        return "ok (report successfully posted)"
-    except:
-        traceback.print_exc()
-        return "error in posting the report"
-
-
-def log_name(ticket_id, report):
-    return "/log%s/%s/%s/%s" % (
-        '/Pending' if report['status'] == 'Pending' else '',
-        ticket_id,
-        '/'.join(report['machine']),
-        report['time'])
-
-
-def prune_pending(ticket, machine=None, timeout=None):
-    """
-    Remove pending reports from ``ticket.reports``,
-    as well as the corresponding log.
-
-    A pending report is removed if ``machine`` is matched
-    or ``report.time`` is longer than ``timeout`` old.
-
-    The ``timeout`` is currently set to 6 hours by default
-
-    The difference with the ``prune_pending`` appearing in util.py
-    it that this one also removes the corresponding log in the
-    database (which does not exist on a patchbot client).
-    """
-    if timeout is None:
-        timeout = 6 * 60 * 60
-    if 'reports' in ticket:
-        reports = ticket['reports']
-    else:
-        return []
-    now = datetime.utcnow()  # in the utc timezone
-    for report in list(reports):
-        if report['status'] == 'Pending':
-            t = date_parser(report['time'])
-            if report['machine'] == machine:
-                reports.remove(report)
-                db.remove_log(log_name(ticket, report))
-            elif (now - t).total_seconds() > timeout:
-                reports.remove(report)
-                db.remove_log(log_name(ticket, report))
-    return reports
+        index = json.loads(form['log_index']) if 'log_index' in form else None
+        report, compression, log_index = check_report(
+            json.loads(form.get('report')),
+            form.get('log_compression', 'bz2'), index)
+    except (ValueError, KeyError, TypeError) as err:
+        return make_response("error in posting the report: {}".format(err),
+                             400)
+    ingest.spool_report(ticket_id, report, request.files.get('log'),
+                        compression, log_index)
+    return make_response("ok (report queued)", 202)
+
+
+@app.route("/reports/bulk", methods=['POST'])
+def post_reports_bulk():
+    """
+    Posting many reports at once, for clients that have a backlog.
+
+    The form field ``reports`` is a json list of dicts with keys
+    ``ticket_id``, ``report``, ``log_compression``, ``log_index`` and
+    ``log``, the name of the file field holding the compressed log (or
+    ``None``).
+
+    All the reports are checked before any is put in the spool, from
+    which they are stored together, see ``ingest.write_batch``.
+    """
+    try:
+        items = json.loads(request.form.get('reports'))
+        checked = []
+        for i, item in enumerate(items):
+            try:
+                report, compression, log_index = check_report(
+                    item['report'], item.get('log_compression', 'bz2'),
+                    item.get('log_index'))
+            except (ValueError, KeyError, TypeError) as err:
+                raise ValueError("report {}: {}".format(i, err))
+            log = request.files.get(item['log']) if item.get('log') else None
+            checked.append((int(item['ticket_id']), report, log,
+                            compression, log_index))
+    except (ValueError, KeyError, TypeError) as err:
+        return make_response("error in posting the reports: {}".format(err),
+                             400)
+    for ticket_id, report, log, compression, log_index in checked:
+        ingest.spool_report(ticket_id, report, log, compression, log_index)
+    return make_response("ok ({} reports queued)".format(len(checked)), 202)
+
+
+def check_report(report, compression, index=None):
+    """
+    Check a posted report.
+
+    INPUT:
+
+    - ``report`` -- the report, as decoded from json
+
+    - ``compression`` -- format of the log, see ``util.LOG_COMPRESSIONS``
+
+    - ``index`` -- positions of the compressed blocks and plugin sections
+      of the log, as computed by the client, or ``None``, see
+      ``check_log_index``
+
+    OUTPUT:
+
+    a triple (report, log compression, fields stored with the log)
+    """
+    if not isinstance(report, dict):
+        raise ValueError("report is not a dict")
+    for fld in ['status', 'spkgs', 'base', 'machine', 'time']:
+        if fld not in report:
+            raise ValueError("{} missing in report".format(fld))
+
+    machine_name = report['machine'][-1]
+    if machine_name in BLACKLIST:
+        raise ValueError('machine {} is blacklisted'.format(machine_name))
+
+    if compression not in available_log_compressions():
+        raise ValueError("unknown log compression")
+
+    log_index = check_log_index(index) if index is not None else {}
+    return report, compression, log_index
+
+
+def check_log_index(index):
+    """
+    Check the positions of the blocks and plugin sections of a log, as
+    sent by a client.
+
+    The blocks must follow each other, both in the log and in the
+    compressed log, and the plugin sections must come in order. That
+    they are inside the log is checked once it is stored, see
+    ``ingest.index_log``.
+
+    OUTPUT:
+
+    the fields stored with the log
+    """
+    blocks = [[int(start), int(cstart), int(length)]
+              for start, cstart, length in index['blocks']]
+    plugins = [[str(name), int(start), int(end)]
+               for name, start, end in index['plugins']]
+    compressed_end = 0
+    for i, (start, cstart, length) in enumerate(blocks):
+        if ((start != 0 if i == 0 else start <= blocks[i - 1][0]) or
+                cstart != compressed_end or length <= 0):
+            raise ValueError("invalid log blocks in log_index")
+        compressed_end = cstart + length
+    previous_end = 0
+    for name, start, end in plugins:
+        if not previous_end <= start < end:
+            raise ValueError("invalid plugin sections in log_index")
+        previous_end = end
+    return {'log_blocks': blocks, 'log_plugins': plugins}
 
 
 def shorten(lines):
     """
     Extract a shorter log from the full log by removing boring parts
+
+    ``lines`` is an iterable over the lines of the log.
     """
     timing = re.compile(r'\s*\[(\d+ tests?, )?\d+\.\d* s\]\s*$')
     skip = re.compile(r'(sage -t.*\(skipping\))|(byte-compiling)|(copying)|(\S+: \d+% \(\d+ of \d+\)|(Build finished. The built documents can be found in.*)|(\[.........\] .*)|(cp.*/mac-app/.*)|(creating.*site-packages/sage.*)|(mkdir.*)|(creating build/.*)|(Deleting empty directory.*)|(;;;.*))$')
@@ -656,7 +1025,7 @@ def shorten(lines):
     from .patchbot import boundary
     plugin_start = re.compile(boundary('.*', 'plugin'))
     plugin_end = re.compile(boundary('.*', 'plugin_end'))
-    for line in StringIO(lines):
+    for line in lines:
         if line.startswith('='):
             if plugin_end.match(line):
                 if prev:
@@ -693,16 +1062,98 @@ def shorten(lines):
         yield prev
 
 
-def extract_plugin_log(data, plugin):
+def log_pieces(log, start=0):
     """
-    Extract from data the log of a given plugin.
+    Iterate over the decompressed content of a stored log.
+
+    This yields pairs (offset, bytes). When the log is made of
+    independently compressed blocks, the blocks before the offset
+    ``start`` are not read.
+    """
+    compression = getattr(log, 'compression', 'bz2')
+    blocks = getattr(log, 'log_blocks', None)
+    if blocks:
+        ends = [block[0] for block in blocks[1:]] + [None]
+        for (offset, compressed_offset, length), end in zip(blocks, ends):
+            if end is not None and end <= start:
+                continue
+            log.seek(compressed_offset)
+            decompressor = log_decompressor(compression)
+            yield offset, decompressor.decompress(log.read(length))
+    else:
+        decompressor = log_decompressor(compression)
+        offset = 0
+        while True:
+            data = log.read(LOG_CHUNK_SIZE)
+            if not data:
+                break
+            data = decompressor.decompress(data)
+            yield offset, data
+            offset += len(data)
+
+
+def read_log(log, start=0, end=None):
+    """
+    Iterate over the text of a stored log, piece by piece.
+
+    The log is decompressed while it is read, according to the format
+    stored with it (old logs are in bz2).
+
+    If given, ``start`` and ``end`` are byte offsets delimiting the part
+    of the log to read.
+    """
+    decoder = codecs.getincrementaldecoder('utf8')('replace')
+    for offset, data in log_pieces(log, start):
+        if end is not None and offset >= end:
+            break
+        data = data[max(start - offset, 0):
+                    None if end is None else end - offset]
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def read_plugin_log(path, plugin):
+    """
+    Return the log of a given plugin from a stored log.
+
+    The positions of the plugin sections are stored with the logs sent
+    by recent clients. Otherwise the log is scanned for the plugin.
+    """
+    log = db.logs.get(path)
+    for name, start, end in getattr(log, 'log_plugins', []):
+        if name == plugin:
+            return ''.join(read_log(log, start, end))
+    return extract_plugin_log(log_lines(read_log(log)), plugin)
+
+
+def log_lines(chunks):
+    """
+    Iterate over the lines of a text given as an iterable of pieces.
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def extract_plugin_log(lines, plugin):
+    """
+    Extract from the lines of a log the log of a given plugin.
     """
     from .patchbot import boundary
     start = boundary(plugin, 'plugin') + "\n"
     end = boundary(plugin, 'plugin_end') + "\n"
     all = []
     include = False
-    for line in StringIO(data):
+    for line in lines:
         if line == start:
             include = True
         if include:
@@ -712,6 +1163,29 @@ def extract_plugin_log(data, plugin):
     return ''.join(all)
 
 
+def plugin_diff(path, base_path, plugin):
+    """
+    Return the diff of the log of a plugin against the one on the base.
+
+    OUTPUT:
+
+    a pair (first line of the plugin log, diff without file names)
+
+    Diffs are stored in the database and computed only once.
+    """
+    cached = db.lookup_plugin_diff(path, base_path, plugin)
+    if cached is not None:
+        return cached['header'], cached['diff']
+    data = read_plugin_log(path, plugin)
+    header = data[:data.find('\n')]
+    base_data = read_plugin_log(base_path, plugin)
+    diff = difflib.unified_diff(base_data.split('\n'), data.split('\n'), n=0)
+    diff = '\n'.join(('' if item[0] == '@' else item)
+                     for item in list(diff)[2:])
+    db.save_plugin_diff(path, base_path, plugin, header, diff)
+    return header, diff
+
+
 @app.route("/ticket/<id>/log/<path:log>")
 def get_ticket_log(id, log):
     return get_log(log)
@@ -719,56 +1193,70 @@ def get_ticket_log(id, log):
 
 @app.route("/log/<path:log>")
 def get_log(log):
+    """
+    Serve a log, decompressed while it is sent.
+
+    possible options: ?short, ?plugin=X and ?plugin=X&diff=<base log>
+    """
     path = "/log/" + log
-    if not db.logs.exists(path):
-        data = "No such log!"
-    else:
-        data = bz2.decompress(db.logs.get(path).read())
+    exists = db.logs.exists(path)
     if 'plugin' in request.args:
         plugin = request.args.get('plugin')
-        data = extract_plugin_log(data, plugin)
-        if 'diff' in request.args:
-            header = data[:data.find('\n')]
-            base = request.args.get('base')
-            ticket_id = request.args.get('ticket')
-            base_data = bz2.decompress(db.logs.get(request.args.get('diff')).read())
-            base_data = extract_plugin_log(base_data, plugin)
-            diff = difflib.unified_diff(base_data.split('\n'), data.split('\n'), base, "%s + #%s" % (base, ticket_id), n=0)
-            data = data = '\n'.join(('' if item[0] == '@' else item)
-                                    for item in diff)
-            if not data:
-                data = "No change."
-            data = header + "\n\n" + data
+        if not exists:
+            data = ''
+        elif 'diff' in request.args:
+            header, diff = plugin_diff(path, request.args.get('diff'), plugin)
+            if diff:
+                base = request.args.get('base')
+                ticket_id = request.args.get('ticket')
+                diff = '\n'.join(['--- %s\n' % base,
+                                  '+++ %s + #%s\n' % (base, ticket_id),
+                                  diff])
+            else:
+                diff = "No change."
+            data = header + "\n\n" + diff
+        else:
+            data = read_plugin_log(path, plugin)
+        chunks = [data]
+    elif exists:
+        chunks = read_log(db.logs.get(path))
+    else:
+        chunks = ["No such log!"]
 
     if 'short' in request.args:
-        response = Response(shorten(data), direct_passthrough=True)
-    else:
-        response = make_response(data)
+        chunks = shorten(log_lines(chunks))
+    response = Response(encode_chunks(chunks), direct_passthrough=True)
     response.headers['Content-type'] = 'text/plain; charset=utf-8'
     return response
 
 
+def encode_chunks(chunks):
+    """
+    Encode in utf8 the pieces of text of a streamed response.
+
+    ``direct_passthrough`` responses are handed as such to the WSGI
+    server, which only accepts bytes.
+    """
+    for chunk in chunks:
+        yield chunk.encode('utf8')
+
+
 @app.route("/ticket/<id>/plugin/<plugin_name>/<timestamp>/")
 def get_plugin_data(id, plugin_name, timestamp):
     ticket = tickets.find_one({'id': int(id)})
     if ticket is None:
         return "Unknown ticket: " + id
-    for report in ticket['reports']:
-        if report['time'] == timestamp:
-            for plugin in report['plugins']:
-                if plugin[0] == plugin_name:
-                    response = make_response(json.dumps(plugin[2],
-                                                        default=lambda x: None,
-                                                        indent=4))
-                    response.headers['Content-type'] = 'text/plain; charset=utf-8'
-                    return response
-            return "Unknown plugin: " + plugin_name
-    return "Unknown report: " + timestamp
-
-
-status_order = ['New', 'ApplyFailed', 'BuildFailed', 'TestsFailed',
-                'PluginFailed', 'TestsPassed', 'Pending',
-                'PluginOnlyFailed', 'PluginOnly', 'NoPatch', 'Spkg']
+    report = db.reports.find_one({'ticket_id': int(id), 'time': timestamp})
+    if report is None:
+        return "Unknown report: " + timestamp
+    for plugin in report['plugins']:
+        if plugin[0] == plugin_name:
+            response = make_response(json.dumps(plugin[2],
+                                                default=lambda x: None,
+                                                indent=4))
+            response.headers['Content-type'] = 'text/plain; charset=utf-8'
+            return response
+    return "Unknown plugin: " + plugin_name
 
 
 @app.route('/icon-Version.svg')
@@ -779,20 +1267,74 @@ def create_base_image_svg():
     EXPERIMENTAL !
     """
     base = request.args.get('base', '7.2.beta8')
-    base = base.replace("alpha", u'α').replace("beta", u'β')
-    split_base = base.split('.')
+    return image_response(*version_badge(base), mimetype='image/svg+xml')
+
+
+@timed_cached_function(None, maxsize=1000)
+def version_badge(base):
+    """
+    Return the svg picture displaying a version number and its ETag.
+
+    The pictures are rendered once for every version.
+    """
+    version = base.replace("alpha", u'α').replace("beta", u'β')
+    split_base = version.split('.')
     if len(split_base) == 2:
-        v_main = base
+        v_main = version
         v_sub = ''
-    else:
+        baseline = 225
+    elif len(split_base) == 3:
         x, y, z = split_base
         v_main = x + '.' + y
         v_sub = z
+        baseline = 150
+    else:
+        v_main = ''
+        v_sub = ''
+        baseline = 150
     svg = render_template('icon-Version.svg', version_main=v_main,
-                          version_sub=v_sub)
-    response = make_response(svg)
-    response.content_type = 'image/svg+xml'
-    return response
+                          version_sub=v_sub,
+                          version_baseline=baseline).encode('utf8')
+    return svg, hashlib.md5(svg).hexdigest()
+
+
+# content and ETag of the images, see ``image_data``
+IMAGES = {}
+
+
+def load_images():
+    """
+    Read all the images of ``IMAGES_DIR`` in memory.
+    """
+    for name in os.listdir(IMAGES_DIR):
+        if name.endswith('.png') or name.endswith('.svg'):
+            image_data(name)
+
+
+def image_data(name):
+    """
+    Return the content of an image of ``IMAGES_DIR`` and its ETag.
+    """
+    try:
+        return IMAGES[name]
+    except KeyError:
+        with open(IMAGES_DIR + name, 'rb') as f:
+            data = f.read()
+        IMAGES[name] = data, hashlib.md5(data).hexdigest()
+        return IMAGES[name]
+
+
+def image_response(data, etag, mimetype, cache_control='max-age=604800'):
+    """
+    Return a response serving an image with its ETag.
+
+    Browsers and proxies asking again with this ETag get an empty answer.
+    """
+    response = make_response(data)
+    response.headers['Content-type'] = mimetype
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 # @app.route("/blob/<status>") # desactivated, to be removed
@@ -829,11 +1371,23 @@ def status_image_svg(status):
     # stupid choice for the moment
     if len(liste) > 1:
         status = liste[0]
-    path = status_image_path(status, image_type='svg')
-    response = make_response(open(path).read())
-    response.headers['Content-type'] = 'image/svg+xml'
-    response.headers['Cache-Control'] = 'max-age=3600'
-    return response
+    return image_response(*image_data(status_image_name(status, 'svg')),
+                          mimetype='image/svg+xml')
+
+
+def status_image_name(status, image_type='png'):
+    """
+    Return the file name of the blob image for a single status.
+
+    There are two different icon sets : 'png' and 'svg'
+
+    For example, the result for 'TestsPassed' should be
+    icon-TestsPassed.png
+    """
+    if image_type == 'png':
+        return 'icon-{}.png'.format(status)
+    else:
+        return 'icon-{}.svg'.format(status)
 
 
 def status_image_path(status, image_type='png'):
@@ -845,10 +1399,7 @@ def status_image_path(status, image_type='png'):
     For example, the result for 'TestsPassed' should be
     images/icon-TestsPassed.png
     """
-    if image_type == 'png':
-        return IMAGES_DIR + 'icon-{}.png'.format(status)
-    else:
-        return IMAGES_DIR + 'icon-{}.svg'.format(status)
+    return IMAGES_DIR + status_image_name(status, image_type)
 
 
 def create_status_image(status, base=None):
@@ -920,18 +1471,48 @@ def create_status_image(status, base=None):
         return open(path).read()
 
 
-def min_status(status_list):
+@app.route("/metrics")
+def serve_metrics():
     """
-    Return the minimal status among a list of status.
+    Serve the metrics of this server process for Prometheus.
+    """
+    response = make_response(metrics.render())
+    response.headers['Content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
-    The order is deduced from a total order encoded in ``status_order``.
 
-    EXAMPLES::
+@app.route("/debug/profiles")
+def debug_profiles():
+    """
+    Serve the list of the profiled requests, see ``profiling``.
+    """
+    if not profiling.enabled():
+        return make_response("Profiling is disabled.", 404)
+    return render_template("profiles.html",
+                           profiles=profiling.list_profiles())
 
-        >>> min_status(['TestsPassed', 'TestsFailed'])
+
+@app.route("/debug/profiles/<name>")
+def debug_profile(name):
     """
-    index = min(status_order.index(status) for status in status_list)
-    return status_order[index]
+    Serve the statistics of a profiled request.
+
+    With ?raw, the file written by cProfile is sent instead.
+    """
+    path = profiling.profile_path(name)
+    if not profiling.enabled() or path is None:
+        return make_response("No such profile.", 404)
+    if 'raw' in request.args:
+        with open(path, 'rb') as f:
+            response = make_response(f.read())
+        response.headers['Content-type'] = 'application/octet-stream'
+        return response
+    output = StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats('cumulative').print_stats(50)
+    response = make_response(output.getvalue())
+    response.headers['Content-type'] = 'text/plain; charset=utf-8'
+    return response
 
 
 @app.route("/robots.txt")
@@ -964,54 +1545,29 @@ def favicon():
         sage: from serve import favicon
         sage: favicon()
     """
-    response = make_response(open(IMAGES_DIR + 'favicon.png').read())
-    response.headers['Content-type'] = 'image/png'
-    return response
-
-
-def get_ticket_status(ticket, base=None, machine=None):
-    """
-    Return the status of the ticket in the database.
+    return image_response(*image_data('favicon.png'), mimetype='image/png')
 
-    INPUT:
 
-    - ``ticket`` -- dictionary
+if os.path.isdir(IMAGES_DIR):
+    load_images()
 
-    - ``base`` -- keyword passed to ``current_reports``
-
-    - ``machine`` -- if given, only look at this machine's reports
-
-    OUTPUT:
-
-    a triple (number of reports, single status, composite status)
-
-    Note that ``Spkg``, ``NoPatch`` and ``New`` are not got from any report.
-    """
-    all = current_reports(ticket, base=base)
-    if machine is not None:
-        all = [r for r in all if r['machine'] == machine]
-    if all:
-        status_list = [report['status'] for report in all]
-        if len(set(status_list)) == 1:
-            composite = single = status_list[0]
-        else:
-            composite = ','.join(status_list)
-            single = min_status(status_list)
-        return len(all), single, composite
-    elif ticket['spkgs']:
-        return 0, 'Spkg', 'Spkg'
-    elif not ticket.get('git_commit'):
-        return 0, 'NoPatch', 'NoPatch'
-    else:
-        return 0, 'New', 'New'
+# also started by ``serve.wsgi``, so that the reports spooled before a
+# restart are stored without waiting for a new one
+ingest.start_writer()
 
 
 def main(args):
     parser = OptionParser()
     parser.add_option("-p", "--port", dest="port")
     parser.add_option("--debug", dest="debug", default=False)
+    parser.add_option("--trac-sync", action="store_true", dest="trac_sync",
+                      help="the tickets are kept up to date by trac_sync")
     (options, args) = parser.parse_args(args)
 
+    if options.trac_sync:
+        global TRAC_SYNC
+        TRAC_SYNC = True
+
     app.run(debug=options.debug, host="0.0.0.0", port=int(options.port))
 
 if __name__ == '__main__':
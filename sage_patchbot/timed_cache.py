@@ -0,0 +1,170 @@
+"""
+A bounded, thread-safe cache whose values expire after some time.
+"""
+import functools
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# the caches created so far, by name, see ``cache_stats``
+CACHES = {}
+
+_MISSING = object()
+
+
+class TimedCache(object):
+    """
+    A cache holding at most ``maxsize`` values, each during ``ttl``
+    seconds (forever if ``ttl`` is ``None``).
+
+    The least recently used values are dropped first. Concurrent misses
+    on the same key compute the value only once, the other threads wait
+    for it.
+
+    If ``shared`` is the path of a SQLite file, the values (which must
+    then be picklable) are also stored there, so that the processes of a
+    multi-worker server share them. The computations themselves are not
+    coordinated between processes.
+    """
+    def __init__(self, name, ttl=60, maxsize=128, shared=None):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()  # key -> (expiry time, value)
+        self._computing = {}  # key -> lock held while computing
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get(self, key, compute):
+        """
+        Return the value for ``key``, calling ``compute()`` on a miss.
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            key_lock = self._computing.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                # computed by another thread in the meantime?
+                value = self._lookup(key)
+                if value is _MISSING:
+                    with self._lock:
+                        self.misses += 1
+                    value = compute()
+                    self._store(key, value)
+        finally:
+            with self._lock:
+                if self._computing.get(key) is key_lock:
+                    del self._computing[key]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def stats(self):
+        """
+        Return a dict with the hit and miss counts and the current size.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._values)}
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._values.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                # most recently used values come last
+                self._values[key] = entry
+                self.hits += 1
+                return entry[1]
+        if self.shared is None:
+            return _MISSING
+        entry = self._shared_lookup(key, now)
+        if entry is None:
+            return _MISSING
+        with self._lock:
+            self._insert(key, entry)
+            self.hits += 1
+        return entry[1]
+
+    def _store(self, key, value):
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._insert(key, (expiry, value))
+        if self.shared is not None:
+            self._shared_store(key, expiry, value)
+
+    def _insert(self, key, entry):
+        self._values.pop(key, None)
+        self._values[key] = entry
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.shared, timeout=10)
+        connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                           '(name TEXT, key TEXT, expiry REAL, value BLOB, '
+                           'PRIMARY KEY (name, key))')
+        return connection
+
+    def _shared_lookup(self, key, now):
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    'SELECT expiry, value FROM cache WHERE name=? AND key=?',
+                    (self.name, repr(key))).fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return None
+        if row is None or (row[0] is not None and row[0] <= now):
+            return None
+        return row[0], pickle.loads(bytes(row[1]))
+
+    def _shared_store(self, key, expiry, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                        (self.name, repr(key), expiry,
+                         sqlite3.Binary(data)))
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            pass
+
+
+def timed_cached_function(refresh_rate=60, maxsize=128, shared=None):
+    """
+    Decorator caching the results of a function in a ``TimedCache``.
+
+    The cache is available as the ``cache`` attribute of the function.
+    """
+    def decorator(func):
+        cache = TimedCache(func.__name__, refresh_rate, maxsize, shared)
+
+        @functools.wraps(func)
+        def wrap(*args):
+            return cache.get(args, lambda: func(*args))
+        wrap.cache = cache
+        return wrap
+    return decorator
+
+
+def cache_stats():
+    """
+    Return a dict name -> hit and miss counts and size of all the caches.
+    """
+    return dict((name, cache.stats()) for name, cache in CACHES.items())
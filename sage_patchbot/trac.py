@@ -9,31 +9,48 @@ import traceback
 import time
 import subprocess
 import pprint
+import threading
+
+try:
+    import queue  # python3
+except ImportError:
+    import Queue as queue  # python2
 
 try:
     # Python 3.3+
-    from xmlrpc.client import ServerProxy
+    from xmlrpc.client import ServerProxy, DateTime, MultiCall, Fault
     from .digest_transport import DigestTransport
     from urllib import parse as url_parse
     from urllib.request import urlopen
 except ImportError:
     # Python 2.7
-    from xmlrpclib import ServerProxy
+    from xmlrpclib import ServerProxy, DateTime, MultiCall, Fault
     from .digest_transport_py2 import DigestTransport
     from urllib2 import urlparse as url_parse
     from urllib2 import urlopen
 
 # imports from patchbot sources
 from .cached_property import cached_property
+from . import metrics
 from .util import (do_or_die, now_str, describe_branch,
                    temp_build_suffix, ensure_free_space,
                    ConfigException, SkipTicket)
-from .trac_ticket import TracTicket
+from .trac_ticket import TracTicket, TracTicket_class, TicketChange
 
 
 TRAC_URL = "https://trac.sagemath.org/sage_trac"
 TRAC_REPO = "git://trac.sagemath.org/sage.git"
 
+# seconds during which a ticket checked against trac is not checked again
+TICKET_TTL = 60
+
+# number of threads checking tickets against trac in the background
+REVALIDATION_THREADS = 4
+
+# seconds after which the snapshot of the branches of TRAC_REPO is
+# refreshed (in the background), see ``remote_refs``
+REMOTE_REFS_TTL = 60
+
 
 def digest(s):
     """
@@ -90,11 +107,40 @@ def get_ticket_info_from_trac_server(ticket_id):
 
     # link to the trac server
     trac_server = TracServer(Config())
-    trac_info = trac_server.load(ticket_id)
+    return ticket_info_from_trac(trac_server.load(ticket_id))
+
+
+def get_tickets_info_from_trac_server(ticket_ids, batch_size=None):
+    """
+    Iterate over the info on several tickets contained in their trac pages.
+
+    The tickets are asked to the trac server in batches of ``batch_size``
+    (see ``TracServer.load_many``). Tickets unknown to trac are skipped.
+    """
+    trac_server = TracServer(Config())
+    # one listing of the branches for all the tickets
+    try:
+        refresh_remote_refs()
+    except Exception:
+        # the branches are then asked one by one
+        traceback.print_exc()
+    for trac_info in trac_server.load_many(ticket_ids, batch_size):
+        yield ticket_info_from_trac(trac_info)
+
+
+def ticket_info_from_trac(trac_info):
+    """
+    Return the patchbot-ticket-info built from a trac ticket.
+
+    INPUT:
+
+    - ``trac_info`` -- a ``TracTicket_class`` object
+    """
+    ticket_id = trac_info.number
 
     # this part is about finding the authors and it needs work !
     authors = set()
-    git_commit_of_branch = git_commit(trac_info.branch)
+    git_commit_of_branch = git_commit(trac_info.branch, trac_info.commit)
     if trac_info.branch:
         branch = trac_info.branch
         if branch.startswith('u/'):
@@ -108,9 +154,6 @@ def get_ticket_info_from_trac_server(ticket_id):
             authors_fullnames.add(author)
     authors_fullnames = list(authors_fullnames)
 
-    # needed to extract the participants
-    rss = get_url("{}/ticket/{}?format=rss".format(TRAC_URL, ticket_id))
-
     return {'id': ticket_id,
             'title': trac_info.title,
             'status': trac_info.status,
@@ -122,7 +165,7 @@ def get_ticket_info_from_trac_server(ticket_id):
             'spkgs': extract_spkgs(trac_info.description),
             'authors': authors,
             'authors_fullnames': authors_fullnames,
-            'participants': extract_participants(rss),
+            'participants': extract_participants(trac_info),
             'git_branch': trac_info.branch,
             'git_repo': TRAC_REPO if trac_info.branch.strip() else None,
             'git_commit': git_commit_of_branch,
@@ -130,7 +173,7 @@ def get_ticket_info_from_trac_server(ticket_id):
             'last_trac_activity': trac_info.mtime_str}
 
 
-def scrape(ticket_id, force=False, db=None):
+def scrape(ticket_id, force=False, db=None, stale_ok=False):
     """
     Return available information about given ticket
     from the patchbot database, and update this information if necessary.
@@ -140,10 +183,16 @@ def scrape(ticket_id, force=False, db=None):
 
     If the trac-ticket-info has changed since the last update of the
     patchbot-ticket-info, then the patchbot-ticket-info is refreshed.
+    A ticket is not compared with trac again during ``TICKET_TTL``
+    seconds.
 
     If ``force`` is ``True``, it will update the patchbot-ticket-info
     even if the trac-ticket-info has not changed.
 
+    If ``stale_ok`` is ``True`` and the ticket is in the patchbot
+    database, its info is returned at once and the comparison with trac
+    is done in a background thread.
+
     OUTPUT:
 
     a dictionary
@@ -166,12 +215,30 @@ def scrape(ticket_id, force=False, db=None):
     # try to get data from the patchbot database
     db_info = db.lookup_ticket(ticket_id)
 
+    if not force and db_info is not None:
+        if is_fresh(ticket_id):
+            return db_info
+        if stale_ok:
+            revalidate_later(ticket_id, db)
+            return db_info
+
+    return refresh(ticket_id, db, db_info, force)
+
+
+def refresh(ticket_id, db, db_info=None, force=False):
+    """
+    Update the patchbot-ticket-info from trac if it has changed.
+
+    Return the up to date patchbot-ticket-info.
+    """
     # check if this data is fresh enough
     if not force and db_info is not None:
         # when did the trac page was last modified ?
         trac_server = TracServer(Config())
-        trac_info = trac_server.load(ticket_id)
+        with metrics.TRAC_SECONDS.time('load'):
+            trac_info = trac_server.load(ticket_id)
         last_trac_activity = trac_info.mtime_str
+        _last_check[ticket_id] = time.time()
 
         known_trac_activity = db_info.get('last_trac_activity',
                                           '1916-01-21 07:03:56')
@@ -181,21 +248,84 @@ def scrape(ticket_id, force=False, db=None):
 
     # nothing in the database or need to refresh
     # now fetch the info from trac server
-    data = get_ticket_info_from_trac_server(ticket_id)
+    ensure_remote_refs()
+    with metrics.TRAC_SECONDS.time('ticket_info'):
+        data = get_ticket_info_from_trac_server(ticket_id)
+    _last_check[ticket_id] = time.time()
     db.save_ticket(data)
     return db.lookup_ticket(ticket_id)
 
 
-def git_commit(branch):
+# ticket id -> time of the last comparison with trac
+_last_check = {}
+
+# tickets waiting for, or under, a background comparison with trac
+_revalidating = set()
+_revalidation_lock = threading.Lock()
+_revalidation_queue = queue.Queue()
+_revalidation_threads = []
+
+
+def is_fresh(ticket_id):
+    """
+    Return whether the ticket was compared with trac less than
+    ``TICKET_TTL`` seconds ago.
+    """
+    return time.time() - _last_check.get(ticket_id, 0) < TICKET_TTL
+
+
+def revalidate_later(ticket_id, db):
+    """
+    Queue the comparison of the ticket with trac.
+
+    A ticket is queued at most once at a time.
+    """
+    with _revalidation_lock:
+        if ticket_id in _revalidating:
+            return
+        _revalidating.add(ticket_id)
+        if not _revalidation_threads:
+            for i in range(REVALIDATION_THREADS):
+                thread = threading.Thread(target=_revalidation_worker)
+                thread.daemon = True
+                thread.start()
+                _revalidation_threads.append(thread)
+    _revalidation_queue.put((ticket_id, db))
+
+
+def _revalidation_worker():
+    while True:
+        ticket_id, db = _revalidation_queue.get()
+        try:
+            refresh(ticket_id, db, db.lookup_ticket(ticket_id))
+        except Exception:
+            # do not ask trac again before the ttl if it is failing
+            _last_check[ticket_id] = time.time()
+            traceback.print_exc()
+        finally:
+            with _revalidation_lock:
+                _revalidating.discard(ticket_id)
+
+
+def git_commit(branch, expected=None):
     """
     Retrieve the hash of the commit.
 
+    The snapshot of the branches of the trac repository is used when
+    there is one (see ``remote_refs``). If the branch is not there, or
+    if its commit differs from ``expected`` (the commit field of the
+    ticket), the trac repository is asked directly.
+
     EXAMPLES::
 
         sage: git_commit('develop')
         '408796407339cf8ba46d3c5ab9365bdb0f1e456f'
     """
     if branch.strip():
+        refs = remote_refs()
+        commit = refs.get(branch.strip()) if refs else None
+        if commit is not None and (not expected or commit == expected):
+            return commit
         try:
             return subprocess.check_output(['git', 'ls-remote',
                                             TRAC_REPO, branch],
@@ -204,6 +334,94 @@ def git_commit(branch):
             return "unknown"
 
 
+def load_remote_refs():
+    """
+    Return a dict branch -> commit for all the branches of the trac
+    repository, obtained with a single ``git ls-remote``.
+    """
+    output = subprocess.check_output(['git', 'ls-remote', '--heads',
+                                      TRAC_REPO],
+                                     universal_newlines=True)
+    refs = {}
+    for line in output.splitlines():
+        commit, ref = line.split()
+        refs[ref[len('refs/heads/'):]] = commit
+    return refs
+
+
+# snapshot of the branches of the trac repository, with the time it was
+# taken and the time of the last attempt to take one
+_remote_refs = {'refs': None, 'time': 0, 'attempt': 0, 'refreshing': False}
+_remote_refs_lock = threading.Lock()
+
+
+def refresh_remote_refs():
+    """
+    Take a new snapshot of the branches of the trac repository.
+    """
+    with _remote_refs_lock:
+        _remote_refs['attempt'] = time.time()
+    refs = load_remote_refs()
+    with _remote_refs_lock:
+        _remote_refs['refs'] = refs
+        _remote_refs['time'] = time.time()
+
+
+def ensure_remote_refs():
+    """
+    Start taking a snapshot of the branches of the trac repository in a
+    background thread if there is none yet.
+
+    Until it is there, ``git_commit`` asks for single branches.
+    """
+    with _remote_refs_lock:
+        if _remote_refs['refs'] is None:
+            _start_refresh()
+
+
+def remote_refs():
+    """
+    Return the snapshot of the branches of the trac repository, as a
+    dict branch -> commit, or ``None`` if there is no snapshot.
+
+    A snapshot older than ``REMOTE_REFS_TTL`` seconds is still returned,
+    while a new one is taken in a background thread.
+    """
+    with _remote_refs_lock:
+        refs = _remote_refs['refs']
+        if refs is not None:
+            _start_refresh()
+    return refs
+
+
+def _start_refresh():
+    """
+    Start taking a new snapshot in a background thread, unless one is
+    being taken or the last attempt is less than ``REMOTE_REFS_TTL``
+    seconds old (failed attempts are not repeated at once).
+
+    This is called with ``_remote_refs_lock`` held.
+    """
+    if (_remote_refs['refreshing'] or
+            time.time() - _remote_refs['attempt'] <= REMOTE_REFS_TTL):
+        return
+    _remote_refs['refreshing'] = True
+    _remote_refs['attempt'] = time.time()
+    thread = threading.Thread(target=_refresh_remote_refs_worker)
+    thread.daemon = True
+    thread.start()
+
+
+def _refresh_remote_refs_worker():
+    try:
+        refresh_remote_refs()
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with _remote_refs_lock:
+            _remote_refs['refreshing'] = False
+
+
 def extract_tag(sgml, tag):
     """
     Find the first occurrence of the tag start (including attributes) and
@@ -225,21 +443,21 @@ def extract_tag(sgml, tag):
     return sgml[start_ix + len(tag): end_ix].strip()
 
 
-def extract_participants(rss):
+def extract_participants(trac_info):
     """
-    Extracts any participants for a ticket from the html page.
+    Extracts any participants for a ticket from its trac changelog.
 
-    This is done using the rss feed.
+    These are the people who commented or changed the ticket, as in the
+    rss feed of the ticket.
 
     This is used in the trust check code for the moment.
 
     This needs work ! In particular to remove people only in cc if possible!
     """
     all = set()
-    for item in rss.split('<item>'):
-        who = extract_tag(item, '<dc:creator>')
-        if who:
-            all.add(who)
+    for change in trac_info.change_iter():
+        if change.author:
+            all.add(change.author)
     return list(all)
 
 spkg_url_regex = re.compile(r"((?:(?:https?://)|(?:/attachment/)).*?\.(?:spkg|tar\.gz|tar\.bz2))")
@@ -380,6 +598,11 @@ class Config(object):
     def server_hostname(self):
         return 'https://trac.sagemath.org'
 
+    @property
+    def multicall_size(self):
+        # number of tickets asked in one system.multicall request
+        return 50
+
     @property
     def server_anonymous_xmlrpc(self):
         return 'xmlrpc'
@@ -408,6 +631,53 @@ class TracServer(object):
         ticket = TracTicket(ticket_number, self.anonymous_proxy)
         return ticket
 
+    def load_many(self, ticket_numbers, batch_size=None):
+        """
+        Iterate over the tickets with the given numbers.
+
+        The calls to ``ticket.get`` and ``ticket.changeLog`` are packed
+        in ``system.multicall`` requests for ``batch_size`` tickets.
+        Tickets that trac does not know are skipped.
+        """
+        from xml.parsers.expat import ExpatError
+        if batch_size is None:
+            batch_size = self.config.multicall_size
+        ticket_numbers = [int(n) for n in ticket_numbers]
+        for i in range(0, len(ticket_numbers), batch_size):
+            batch = ticket_numbers[i:i + batch_size]
+            multicall = MultiCall(self.anonymous_proxy)
+            for ticket_number in batch:
+                multicall.ticket.get(ticket_number)
+                multicall.ticket.changeLog(ticket_number)
+            try:
+                results = multicall()
+            except ExpatError:
+                # a malformed changelog spoils the whole batch
+                print('Failed to parse the trac answer, loading one by one')
+                for ticket_number in batch:
+                    try:
+                        yield self.load(ticket_number)
+                    except Fault:
+                        print('Unknown ticket #{}'.format(ticket_number))
+                continue
+            for k, ticket_number in enumerate(batch):
+                try:
+                    data = results[2 * k]
+                    change_log = results[2 * k + 1]
+                except Fault:
+                    print('Unknown ticket #{}'.format(ticket_number))
+                    continue
+                yield TracTicket_class(data[0], data[1], data[2], data[3],
+                                       [TicketChange(entry)
+                                        for entry in change_log])
+
+    def recent_changes(self, since):
+        """
+        Return the list of ids of the tickets modified since the
+        datetime ``since`` (in the utc timezone).
+        """
+        return self.anonymous_proxy.ticket.getRecentChanges(DateTime(since))
+
     def remote_branch(self, ticket_number):
         ticket = self.load(ticket_number)
         branch = ticket.branch
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the tickets of the patchbot database synchronized with trac.
+
+This is a worker running next to the patchbot server. It asks trac which
+tickets were modified since its last pass and saves their info in the
+database, so that the server does not need to contact trac while
+answering requests (see the option ``--trac-sync`` of ``serve.py``).
+
+It is started with
+
+    python -m sage_patchbot.trac_sync [--interval=60]
+
+A range of tickets can also be loaded once with
+
+    python -m sage_patchbot.trac_sync --tickets=20000-21000
+"""
+from __future__ import absolute_import
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+# imports from patchbot sources
+from .trac import TracServer, Config, get_tickets_info_from_trac_server
+from . import db
+
+# key of the high-water mark in ``db.state``
+SYNC_STATE_KEY = 'trac_sync'
+
+# the changes are asked from a bit before the previous pass, in case
+# the clocks of trac and of the patchbot server differ
+OVERLAP = timedelta(minutes=5)
+
+
+def sync_once(trac_server, since):
+    """
+    Save in the database the tickets modified on trac since ``since``.
+
+    Return the number of tickets saved.
+    """
+    ticket_ids = sorted(set(trac_server.recent_changes(since - OVERLAP)))
+    return save_tickets(ticket_ids)
+
+
+def save_tickets(ticket_ids):
+    """
+    Save in the database the info on the given tickets, read from trac.
+
+    Return the number of tickets saved.
+    """
+    count = 0
+    for data in get_tickets_info_from_trac_server(ticket_ids):
+        try:
+            db.save_ticket(data)
+            count += 1
+        except Exception:
+            print("Error for {}".format(data['id']))
+            traceback.print_exc()
+    return count
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option("--interval", dest="interval", type="int", default=60,
+                      help="seconds between two passes")
+    parser.add_option("--since", dest="since",
+                      help="start from this time instead of the last pass, "
+                           "for example '2017-03-21 10:05:00'")
+    parser.add_option("--tickets", dest="tickets",
+                      help="only load this range of tickets and exit, "
+                           "for example '20000-21000'")
+    (options, args) = parser.parse_args(args)
+
+    if options.tickets:
+        start, end = options.tickets.split('-')
+        count = save_tickets(range(int(start), int(end) + 1))
+        print("{} tickets loaded".format(count))
+        return
+
+    trac_server = TracServer(Config())
+    if options.since:
+        since = datetime.strptime(options.since, '%Y-%m-%d %H:%M:%S')
+    else:
+        since = db.lookup_state(SYNC_STATE_KEY)
+    if since is None:
+        since = datetime.utcnow() - timedelta(days=1)
+
+    while True:
+        start = datetime.utcnow()
+        try:
+            count = sync_once(trac_server, since)
+            print("{}: {} tickets synchronized".format(start, count))
+            since = start
+            db.save_state(SYNC_STATE_KEY, since)
+        except Exception:
+            traceback.print_exc()
+        time.sleep(options.interval)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,9 +1,18 @@
+import bz2
+import gzip
+import io
 import os
 import re
 import subprocess
+import zlib
 
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 temp_build_suffix = "-sage-git-temp-"
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
@@ -34,32 +43,6 @@ def now_str():
     return datetime.utcnow().strftime(DATE_FORMAT)
 
 
-def prune_pending(ticket, machine=None, timeout=None):
-    """
-    Remove pending reports from ``ticket.reports``.
-
-    A pending report is removed if ``machine`` is matched
-    or ``report.time`` is longer than ``timeout`` old.
-
-    The ``timeout`` is currently set to 6 hours by default
-    """
-    if timeout is None:
-        timeout = 6 * 60 * 60
-    if 'reports' in ticket:
-        reports = ticket['reports']
-    else:
-        return []
-    now = datetime.utcnow()  # in the utc timezone
-    for report in list(reports):
-        if report['status'] == 'Pending':
-            t = date_parser(report['time'])
-            if report['machine'] == machine:
-                reports.remove(report)
-            elif (now - t).total_seconds() > timeout:
-                reports.remove(report)
-    return reports
-
-
 def latest_version(reports):
     """
     Return the newest ``report.base`` in the given list of reports.
@@ -134,6 +117,178 @@ def current_reports(ticket, base=None, unique=False, newer=False):
     return [rep for rep in reports if filtre_fun(rep)]
 
 
+status_order = ['New', 'ApplyFailed', 'BuildFailed', 'TestsFailed',
+                'PluginFailed', 'TestsPassed', 'Pending',
+                'PluginOnlyFailed', 'PluginOnly', 'NoPatch', 'Spkg']
+
+
+def min_status(status_list):
+    """
+    Return the minimal status among a list of status.
+
+    The order is deduced from a total order encoded in ``status_order``.
+
+    EXAMPLES::
+
+        >>> min_status(['TestsPassed', 'TestsFailed'])
+    """
+    index = min(status_order.index(status) for status in status_list)
+    return status_order[index]
+
+
+def get_ticket_status(ticket, base=None, machine=None):
+    """
+    Return the status of the ticket in the database.
+
+    INPUT:
+
+    - ``ticket`` -- dictionary
+
+    - ``base`` -- keyword passed to ``current_reports``
+
+    - ``machine`` -- if given, only look at this machine's reports
+
+    OUTPUT:
+
+    a triple (number of reports, single status, composite status)
+
+    Note that ``Spkg``, ``NoPatch`` and ``New`` are not got from any report.
+    """
+    all = current_reports(ticket, base=base)
+    if machine is not None:
+        all = [r for r in all if r['machine'] == machine]
+    if all:
+        status_list = [report['status'] for report in all]
+        if len(set(status_list)) == 1:
+            composite = single = status_list[0]
+        else:
+            composite = ','.join(status_list)
+            single = min_status(status_list)
+        return len(all), single, composite
+    elif ticket['spkgs']:
+        return 0, 'Spkg', 'Spkg'
+    elif not ticket.get('git_commit'):
+        return 0, 'NoPatch', 'NoPatch'
+    else:
+        return 0, 'New', 'New'
+
+
+# compression formats of the logs sent to the patchbot server,
+# zstd requires the zstandard module
+LOG_COMPRESSIONS = ('bz2', 'gzip', 'zstd')
+
+# logs are compressed in independent blocks of about this many bytes
+LOG_BLOCK_SIZE = 2 ** 20
+
+
+def available_log_compressions():
+    """
+    Return the list of the formats of ``LOG_COMPRESSIONS`` usable here.
+    """
+    available = ['bz2', 'gzip']
+    if zstandard is not None:
+        available.append('zstd')
+    return available
+
+
+def compress_log(data, compression='bz2'):
+    """
+    Compress the bytes ``data`` of a log in the given format.
+    """
+    if compression == 'bz2':
+        return bz2.compress(data)
+    elif compression == 'gzip':
+        output = io.BytesIO()
+        with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=6) as f:
+            f.write(data)
+        return output.getvalue()
+    elif compression == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError('unknown log compression {}'.format(compression))
+
+
+def compress_log_blocks(data, compression='bz2', block_size=None):
+    """
+    Compress the bytes ``data`` of a log as independently compressed blocks.
+
+    Blocks are cut at line ends, so that every block can be decompressed
+    and decoded on its own.
+
+    OUTPUT:
+
+    a pair (compressed data, blocks) where blocks is a list of triples
+    [offset in ``data``, offset in the compressed data, compressed length]
+    """
+    if block_size is None:
+        block_size = LOG_BLOCK_SIZE
+    pieces = []
+    blocks = []
+    start = compressed_start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + block_size)
+        end = len(data) if end == -1 else end + 1
+        piece = compress_log(data[start:end], compression)
+        pieces.append(piece)
+        blocks.append([start, compressed_start, len(piece)])
+        start = end
+        compressed_start += len(piece)
+    return b''.join(pieces), blocks
+
+
+def plugin_offsets(log):
+    """
+    Return the positions of the plugin sections in a log.
+
+    INPUT:
+
+    - ``log`` -- the log as bytes
+
+    OUTPUT:
+
+    a list of triples [plugin name, start, end] where start and end are
+    the byte offsets of the plugin boundaries (end boundary included)
+    """
+    marker = re.compile(b'^={10} (.*) ={10}$\n?', re.M)
+    starts = {}
+    offsets = []
+    for match in marker.finditer(log):
+        name = match.group(1).decode('utf8', 'replace')
+        if name.startswith('end ') and name[4:] in starts:
+            offsets.append([name[4:], starts.pop(name[4:]), match.end()])
+        else:
+            starts[name] = match.start()
+    return offsets
+
+
+def log_decompressor(compression='bz2'):
+    """
+    Return an object whose ``decompress`` method decompresses a log in
+    the given format piece by piece.
+    """
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('unknown log compression {}'.format(compression))
+
+
+def decompress_log(data, compression='bz2'):
+    """
+    Decompress the bytes ``data`` of a log in the given format.
+
+    The log may be made of several independently compressed blocks, see
+    ``compress_log_blocks``.
+    """
+    pieces = []
+    while data:
+        decompressor = log_decompressor(compression)
+        pieces.append(decompressor.decompress(data))
+        data = getattr(decompressor, 'unused_data', b'')
+    return b''.join(pieces)
+
+
 def is_git(sage_root):
     """
     Return ``True`` if sage_root has a .git directory.